@@ -3,13 +3,184 @@ Helpers required to adapt to differing APIs
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import threading
 from contextlib import contextmanager
 
 from fs.memoryfs import MemoryFS
+from fs.path import abspath, normpath
 from fs.wrapfs import WrapFS
 
 from xmodule.xml_module import XmlParserMixin
 
+# State of the current export_session(), if any
+_session = {'depth': 0, 'old_export_to_file': None, 'runtimes': []}
+_session_lock = threading.Lock()
+
+
+class RecordingMemoryFS(MemoryFS):
+    """
+    In-memory filesystem that keeps track of which files get written to it,
+    and which directories get created.
+
+    All of the ways of writing a file (open, writebytes, upload, etc.) go
+    through openbin(), and makedirs() goes through makedir(), so that's
+    where we hook in.
+    """
+
+    def __init__(self):
+        super(RecordingMemoryFS, self).__init__()
+        self.written = []  # Paths of the files written, in order
+        self.made_dirs = []  # Paths of the directories created, in order
+
+    def openbin(self, path, mode='r', buffering=-1, **options):
+        """
+        Open a binary file, recording its path if it's opened for writing.
+        """
+        if any(flag in mode for flag in 'wax+'):
+            path = abspath(normpath(path))
+            if path not in self.written:
+                self.written.append(path)
+        return super(RecordingMemoryFS, self).openbin(path, mode, buffering, **options)
+
+    def makedir(self, path, permissions=None, recreate=False):
+        """
+        Make a directory, recording its path if it didn't exist yet.
+        """
+        path = abspath(normpath(path))
+        existed = self.isdir(path)
+        result = super(RecordingMemoryFS, self).makedir(path, permissions=permissions, recreate=recreate)
+        if not existed:
+            self.made_dirs.append(path)
+        return result
+
+
+class ExportFS(WrapFS):
+    """
+    The in-memory filesystem that blocks export their extra files into, which
+    can be reused (after reset()) for one block after another. Each thread
+    has its own; see get_thread_export_fs().
+    """
+
+    def __init__(self):
+        super(ExportFS, self).__init__(RecordingMemoryFS())
+        self.makedir('course')
+        self.makedir('course/static')  # Video XBlock requires this directory to exists, to put srt files etc.
+        del self.delegate_fs().made_dirs[:]  # These are kept by reset()
+
+    @property
+    def written_files(self):
+        """
+        Paths of the files that have been written since the last reset(), in order.
+        """
+        return [path for path in self.delegate_fs().written if self.isfile(path)]
+
+    def reset(self):
+        """
+        Delete any files that have been written and directories that have been
+        created, so the next block starts with the same layout as a new ExportFS.
+        """
+        for path in self.written_files:
+            self.remove(path)
+        for path in reversed(self.delegate_fs().made_dirs):
+            if self.isdir(path):
+                self.removetree(path)
+        del self.delegate_fs().written[:]
+        del self.delegate_fs().made_dirs[:]
+
+
+class ThreadLocalExportFS(object):
+    """
+    Stands in for a runtime's 'export_fs' during an export_session(),
+    forwarding everything to the ExportFS of whichever thread is using it.
+    This way many blocks sharing one runtime can be serialized at once on
+    different threads, without swapping the runtime's attribute per block.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_thread_export_fs(), name)
+
+
+_thread_local = threading.local()
+_proxy_fs = ThreadLocalExportFS()
+
+
+def get_thread_export_fs():
+    """
+    Get the ExportFS belonging to the current thread, creating it if needed.
+    """
+    fs = getattr(_thread_local, 'fs', None)
+    if fs is None:
+        fs = _thread_local.fs = ExportFS()
+    return fs
+
+
+@contextmanager
+def export_session():
+    """
+    Set up for exporting any number of blocks with override_export_fs(),
+    possibly from several threads at once.
+
+    XmlParserMixin.export_to_file() is patched once for the whole session
+    (see override_export_fs()) rather than once per block, and each thread
+    reuses a single ExportFS for every block it exports. Sessions can be
+    nested (including from other threads while the outer session is active);
+    only the outermost one has any effect.
+    """
+    with _session_lock:
+        _session['depth'] += 1
+        if _session['depth'] == 1:
+            _session['old_export_to_file'] = XmlParserMixin.export_to_file
+            # So this applies to child blocks that get loaded during export:
+            XmlParserMixin.export_to_file = lambda _: False
+    try:
+        yield
+    finally:
+        with _session_lock:
+            _session['depth'] -= 1
+            if _session['depth'] == 0:
+                XmlParserMixin.export_to_file = _session['old_export_to_file']
+                for runtime, old_export_fs, old_add_block_as_child_node in _session['runtimes']:
+                    runtime.export_fs = old_export_fs
+                    if old_add_block_as_child_node is None:
+                        del runtime.add_block_as_child_node  # Back to the class's method
+                    else:
+                        runtime.add_block_as_child_node = old_add_block_as_child_node
+                _session['old_export_to_file'] = None
+                _session['runtimes'] = []
+
+
+def _use_thread_local_export_fs(runtime):
+    """
+    Make the given runtime use the current thread's ExportFS for the rest of
+    the export session, and leave out children for threads that are in
+    without_children().
+    """
+    with _session_lock:
+        if runtime.export_fs is not _proxy_fs:
+            _session['runtimes'].append((runtime, runtime.export_fs, vars(runtime).get('add_block_as_child_node')))
+            runtime.export_fs = _proxy_fs
+            add_block_as_child_node = runtime.add_block_as_child_node
+
+            def add_block_as_child_node_unless_without_children(block, node):
+                """ Blocks add their children's OLX through this """
+                if not getattr(_thread_local, 'without_children', False):
+                    add_block_as_child_node(block, node)
+            runtime.add_block_as_child_node = add_block_as_child_node_unless_without_children
+
+
+@contextmanager
+def without_children():
+    """
+    Within an override_export_fs() block, make blocks serialized on this
+    thread leave out their children's OLX (and any files the children would
+    export), without changing the blocks' 'children' field.
+    """
+    _thread_local.without_children = True
+    try:
+        yield
+    finally:
+        _thread_local.without_children = False
+
 
 @contextmanager
 def override_export_fs(block):
@@ -19,27 +190,29 @@ def override_export_fs(block):
     XmlSerializationMixin.add_xml_to_node() method.
 
     This method temporarily replaces a block's runtime's
-    'export_fs' system with an in-memory filesystem.
+    'export_fs' system with an in-memory filesystem (the current thread's
+    ExportFS, whose written_files are the files the block exported).
 
     This method also abuses the XmlParserMixin.export_to_file()
     API to prevent the XModule export code from exporting each
     block as two files (one .olx pointing to one .xml file).
     The export_to_file was meant to be used only by the
     customtag XModule but it makes our lives here much easier.
+
+    Within an export_session() the global patch and the runtime's export_fs
+    stay in place until the session ends; otherwise they are set up just for
+    this block. The only per-block change is to the block instance itself,
+    so different blocks can safely be exported on different threads.
     """
-    fs = WrapFS(MemoryFS())
-    fs.makedir('course')
-    fs.makedir('course/static')  # Video XBlock requires this directory to exists, to put srt files etc.
-
-    old_export_fs = block.runtime.export_fs
-    block.runtime.export_fs = fs
-    if hasattr(block, 'export_to_file'):
-        old_export_to_file = block.export_to_file
-        block.export_to_file = lambda: False
-    old_global_export_to_file = XmlParserMixin.export_to_file
-    XmlParserMixin.export_to_file = lambda _: False  # So this applies to child blocks that get loaded during export
-    yield fs
-    block.runtime.export_fs = old_export_fs
-    if hasattr(block, 'export_to_file'):
-        block.export_to_file = old_export_to_file
-    XmlParserMixin.export_to_file = old_global_export_to_file
+    with export_session():
+        fs = get_thread_export_fs()
+        fs.reset()
+        _use_thread_local_export_fs(block.runtime)
+        if hasattr(block, 'export_to_file'):
+            old_export_to_file = block.export_to_file
+            block.export_to_file = lambda: False
+        try:
+            yield fs
+        finally:
+            if hasattr(block, 'export_to_file'):
+                block.export_to_file = old_export_to_file
@@ -0,0 +1,296 @@
+"""
+Caches of static asset files loaded from the contentstore
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import six
+from django.conf import settings
+
+from .lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+# Size of the chunks that cached files are read in
+READ_CHUNK_SIZE = 1024 * 1024
+
+# How often the DiskAssetCache re-reads its directory, to pick up files added
+# or removed by other processes:
+RESCAN_SECONDS = 600
+
+_disk_asset_cache = {}  # Holds the DiskAssetCache configured in settings, once created
+_asset_memo = {}  # Holds this process's AssetMemo, once created
+
+# Stored in the AssetMemo for assets that don't exist
+NOT_FOUND = object()
+
+
+def get_disk_asset_cache():
+    """
+    Get the DiskAssetCache configured by the LX_EXPORTER_ASSET_CACHE_DIR
+    setting, or None if it's not enabled.
+    """
+    if not settings.LX_EXPORTER_ASSET_CACHE_DIR:
+        return None
+    if 'cache' not in _disk_asset_cache:
+        _disk_asset_cache['cache'] = DiskAssetCache(
+            settings.LX_EXPORTER_ASSET_CACHE_DIR, settings.LX_EXPORTER_ASSET_CACHE_MAX_BYTES,
+        )
+    return _disk_asset_cache['cache']
+
+
+def get_asset_memo():
+    """
+    Get this process's AssetMemo, sized by the LX_EXPORTER_ASSET_MEMO_MAX_BYTES setting.
+    """
+    if 'memo' not in _asset_memo:
+        _asset_memo['memo'] = AssetMemo(settings.LX_EXPORTER_ASSET_MEMO_MAX_BYTES)
+    return _asset_memo['memo']
+
+
+class MemoizedAsset(object):
+    """
+    A static asset whose contents are held in memory and shared by every
+    block that uses it; it provides the parts of the contentstore's
+    StaticContent API that we use.
+    """
+
+    def __init__(self, location, data):
+        self.location = location
+        self.length = len(data)
+        self.data = data
+
+    def stream_data(self):
+        """
+        Yield the contents (in one chunk).
+        """
+        yield self.data
+
+    def close(self):
+        """
+        Nothing to release; the data is shared.
+        """
+        pass
+
+
+class AssetMemo(object):
+    """
+    In-memory memo of the assets found at each (course key, path), including
+    the ones that weren't found, so that sibling blocks referencing the same
+    file share a single contentstore read and a single copy of its data.
+
+    Assets are held in memory up to max_bytes in total, evicting the least
+    recently used. Large assets (which are streamed rather than loaded) are
+    not memoized.
+    """
+
+    def __init__(self, max_bytes):
+        self._cache = LRUCache(max_bytes, get_size=self._memo_size)
+
+    @staticmethod
+    def _memo_size(value):
+        """
+        How many bytes of memory does a memoized value count as?
+        """
+        return value.length if isinstance(value, MemoizedAsset) else 1
+
+    @property
+    def hits(self):
+        """ Number of lookups that found a memoized asset (or NOT_FOUND) """
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        """ Number of lookups that found nothing memoized """
+        return self._cache.misses
+
+    def lookup(self, course_key, path):
+        """
+        Get the memoized asset found at 'path' in the given course: either a
+        MemoizedAsset, NOT_FOUND, or None if we don't know.
+        """
+        return self._cache.get((six.text_type(course_key), path))
+
+    def remember(self, course_key, path, content):
+        """
+        Memoize the asset found at 'path' in the given course. 'content' is the
+        StaticContentStream or CachedAsset that was found, or None.
+
+        Returns the content for the caller to use in place of the original,
+        which may have been consumed.
+        """
+        key = (six.text_type(course_key), path)
+        if content is None:
+            self._cache.put(key, NOT_FOUND)
+        elif content.length <= settings.LX_EXPORTER_MULTIPART_CHUNK_SIZE:
+            data = b''.join(content.stream_data())
+            content.close()
+            content = MemoizedAsset(content.location, data)
+            self._cache.put(key, content)
+        return content
+
+
+class CachedAsset(object):
+    """
+    A static asset whose contents are in a local file; it provides the parts of
+    the contentstore's StaticContentStream API that we use.
+    """
+
+    def __init__(self, location, length, path):
+        self.location = location
+        self.length = length
+        self.path = path
+
+    def stream_data(self):
+        """
+        Yield the contents of the file in chunks.
+        """
+        with open(self.path, 'rb') as fh:
+            chunk = fh.read(READ_CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = fh.read(READ_CHUNK_SIZE)
+
+    def close(self):
+        """
+        Nothing to release; the file is only open while it's being read.
+        """
+        pass
+
+
+class DiskAssetCache(object):
+    """
+    Persistent cache of contentstore asset data in a local directory, so that
+    repeated and resumed runs don't need to re-read the same files from GridFS.
+
+    Entries are keyed by the asset key plus its content digest (or upload
+    date), so a re-uploaded asset gets a new entry. The total size of the
+    cache is capped at max_bytes by evicting the least recently used files,
+    as tracked by an in-memory index of the files. The directory can be
+    shared by several processes: a file's modification time is updated
+    whenever it's used, and the index is rebuilt from the directory every
+    RESCAN_SECONDS.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._files = OrderedDict()  # Path -> (size, time last used), least recently used first
+        self._total_bytes = 0
+        self._scanned_at = 0
+        self._scan()
+
+    def _scan(self):
+        """
+        Rebuild the index of files from what's in the cache directory. Must be
+        called with the lock held (or before any other thread can use the cache).
+        """
+        self._files = OrderedDict(
+            (path, (size, mtime)) for path, size, mtime in sorted(self._cached_files(), key=lambda item: item[2])
+        )
+        self._total_bytes = sum(size for size, _last_used in self._files.values())
+        self._scanned_at = time.time()
+
+    def _used(self, path, size):
+        """
+        Record in the index that a file was just used (or added). Must be
+        called with the lock held.
+        """
+        old = self._files.pop(path, None)
+        if old is None:
+            self._total_bytes += size
+        self._files[path] = (size, time.time())
+
+    def _cached_files(self):
+        """
+        Yield (path, size, modification time) of each file in the cache.
+        """
+        for dir_path, _dir_names, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # Evicted by another process
+                yield path, stat.st_size, stat.st_mtime
+
+    def _path(self, content):
+        """
+        Get the path of the cache file for the given StaticContent.
+        """
+        version = getattr(content, 'content_digest', None) or getattr(content, 'last_modified_at', None)
+        cache_key = hashlib.sha1(
+            '{}|{}'.format(six.text_type(content.location), version).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.cache_dir, cache_key[:2], cache_key)
+
+    def wrap(self, content):
+        """
+        Given a contentstore StaticContentStream, return a CachedAsset with the
+        same contents read from the cache, copying them into the cache first
+        if they aren't already there.
+        """
+        path = self._path(content)
+        try:
+            os.utime(path, None)  # Mark as recently used, for other processes
+        except OSError:
+            pass
+        else:
+            content.close()
+            with self._lock:
+                self.hits += 1
+                self._used(path, content.length)
+            return CachedAsset(content.location, content.length, path)
+
+        with self._lock:
+            self.misses += 1
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # Created by another thread or process in the meantime
+        # Write to a temporary file first, so no other process ever sees a partial file:
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as fh:
+            for chunk in content.stream_data():
+                fh.write(chunk)
+        content.close()
+        os.rename(tmp_path, path)
+        with self._lock:
+            self._used(path, content.length)
+            if time.time() - self._scanned_at > RESCAN_SECONDS:
+                self._scan()
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return CachedAsset(content.location, content.length, path)
+
+    def _evict(self):
+        """
+        Delete the least recently used files until the cache is within its
+        size limit. Must be called with the lock held.
+        """
+        # Never evict files that were just used, as they may be about to be read:
+        recent = time.time() - 60
+        while self._files and self._total_bytes > self.max_bytes:
+            path, (size, last_used) = next(iter(self._files.items()))
+            if last_used > recent:
+                break
+            del self._files[path]
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Evicted by another process
+        log.debug("Asset cache is now %s bytes", self._total_bytes)
@@ -5,18 +5,65 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import logging
 import os
-from collections import namedtuple
+from collections import OrderedDict
 
 import six
+from django.conf import settings
 from lxml import etree
 
 from . import compat
-from .adapters import override_export_fs
+from .adapters import override_export_fs, without_children
+from .fast_serializers import serialize_block_fast
+from .lru import LRUCache
 
 log = logging.getLogger(__name__)
 
-# A static file required by an XBlock
-StaticFile = namedtuple('StaticFile', ['name', 'data'])
+
+class StaticFile(object):
+    """
+    A static file required by an XBlock. Either 'data' holds its contents, or
+    (for files too large to keep in memory) 'stream' is a contentstore
+    StaticContentStream that the contents can be read from in chunks.
+    """
+    __slots__ = ('name', 'data', 'size', 'stream')
+
+    def __init__(self, name, data=None, size=None, stream=None):
+        self.name = name
+        self.data = data
+        self.size = len(data) if size is None else size
+        self.stream = stream
+
+
+class StaticFileSet(object):
+    """
+    The StaticFiles required by an XBlock, in the order they were added and
+    indexed by name (so checking for duplicates is O(1)).
+    """
+    __slots__ = ('_files', 'total_size')
+
+    def __init__(self):
+        self._files = OrderedDict()  # Name -> StaticFile
+        self.total_size = 0  # Total size in bytes of all the files
+
+    def __contains__(self, name):
+        return name in self._files
+
+    def __iter__(self):
+        return iter(self._files.values())
+
+    def __len__(self):
+        return len(self._files)
+
+    def add(self, static_file):
+        """
+        Add a StaticFile, unless there's already one with the same name.
+        Returns True if it was added.
+        """
+        if static_file.name in self._files:
+            return False
+        self._files[static_file.name] = static_file
+        self.total_size += static_file.size
+        return True
 
 
 def blockstore_def_key_from_modulestore_usage_key(usage_key):
@@ -40,13 +87,45 @@ def blockstore_def_key_from_modulestore_usage_key(usage_key):
     return block_type + "/" + usage_key.block_id
 
 
+def serialize_with_add_xml_to_node(block):
+    """
+    The generic way of serializing a block: have it export itself with
+    add_xml_to_node(), and collect any files it exports along the way.
+
+    Returns a tuple of (OLX etree Element without the block's children, list
+    of StaticFiles).
+    """
+    # Create an XML node to hold the exported data
+    olx_node = etree.Element("root")  # The node name doesn't matter: add_xml_to_node will change it
+    # ^ Note: We could pass nsmap=xblock.core.XML_NAMESPACES here, but the
+    # resulting XML namespace attributes don't seem that useful?
+    static_files = []
+    with override_export_fs(block) as filesystem:  # Needed for XBlocks that inherit XModuleDescriptor
+        # Tell the block to serialize itself as XML/OLX. We don't want the
+        # children serialized at this time, because otherwise we can't tell
+        # which files in 'filesystem' belong to this block and which belong to
+        # its children. (This only affects the current thread, so it's safe
+        # while other blocks are serialized on other threads.)
+        with without_children():
+            block.add_xml_to_node(olx_node)
+
+        # Now the block/module may have exported addtional data as files in
+        # 'filesystem'. If so, store them:
+        for file_path in filesystem.written_files:
+            with filesystem.open(file_path, 'rb') as fh:
+                data = fh.read()
+            static_files.append(StaticFile(name=os.path.basename(file_path), data=data))
+    return olx_node, static_files
+
+
 class XBlockSerializer(object):
     """
     This class will serialize an XBlock, producing:
         (1) A new definition ID for use in Blockstore
         (2) an XML string defining the XBlock and referencing the IDs of its
             children (but not containing the actual XML of its children)
-        (3) a list of any static files required by the XBlock and their data
+        (3) a StaticFileSet of any static files required by the XBlock and
+            their data (static_files.total_size gives their total size)
     """
 
     def __init__(self, block):
@@ -55,7 +134,7 @@ class XBlockSerializer(object):
         resulting data in this object.
         """
         self.orig_block_key = block.scope_ids.usage_id
-        self.static_files = []
+        self.static_files = StaticFileSet()
         self.def_id = blockstore_def_key_from_modulestore_usage_key(self.orig_block_key)
 
         # Special cases:
@@ -66,39 +145,21 @@ class XBlockSerializer(object):
 
         course_key = self.orig_block_key.course_key
         # Search the OLX for references to files stored in the course's
-        # "Files & Uploads" (contentstore):
-        self.olx_str = compat.rewrite_absolute_static_urls(self.olx_str, course_key)
-        for asset in compat.collect_assets_from_text(self.olx_str, course_key):
+        # "Files & Uploads" (contentstore), normalizing them to /static/ paths:
+        self.olx_str, static_paths = compat.rewrite_static_urls_and_find_paths(self.olx_str, course_key)
+        for asset in compat.collect_assets_from_paths(static_paths, course_key):
             # TODO: need to rewrite the URLs/paths in the olx_str to the new format/location
             self.add_static_asset(asset['content'])
 
     def serialize_normal_block(self, block):
-        # Create an XML node to hold the exported data
-        olx_node = etree.Element("root")  # The node name doesn't matter: add_xml_to_node will change it
-        # ^ Note: We could pass nsmap=xblock.core.XML_NAMESPACES here, but the
-        # resulting XML namespace attributes don't seem that useful?
-        with override_export_fs(block) as filesystem:  # Needed for XBlocks that inherit XModuleDescriptor
-            # Tell the block to serialize itself as XML/OLX:
-            if not block.has_children:
-                block.add_xml_to_node(olx_node)
-            else:
-                # We don't want the children serialized at this time, because
-                # otherwise we can't tell which files in 'filesystem' belong to
-                # this block and which belong to its children. So, temporarily
-                # disable any children:
-                children = block.children
-                block.children = []
-                block.add_xml_to_node(olx_node)
-                block.children = children
-
-            # Now the block/module may have exported addtional data as files in
-            # 'filesystem'. If so, store them:
-            for item in filesystem.walk():  # pylint: disable=not-callable
-                for unit_file in item.files:
-                    file_path = os.path.join(item.path, unit_file.name)
-                    with filesystem.open(file_path, 'rb') as fh:
-                        data = fh.read()
-                    self.static_files.append(StaticFile(name=unit_file.name, data=data))
+        olx_node = None
+        if settings.LX_EXPORTER_FAST_SERIALIZERS:
+            # Common types can be built straight from their fields; see fast_serializers.py
+            olx_node = serialize_block_fast(block)
+        if olx_node is None:
+            olx_node, static_files = serialize_with_add_xml_to_node(block)
+            for static_file in static_files:
+                self.static_files.add(static_file)
         # Apply some transformations to the OLX:
         self.transform_olx(olx_node)
         # Add  <xblock-include /> tags for each child (XBlock XML export
@@ -146,8 +207,20 @@ class XBlockSerializer(object):
         """
         # note: asset.name is a human-friendly name, not necessarily the file name.
         filename = asset.location.path
-        if filename not in [sf.name for sf in self.static_files]:
-            self.static_files.append(StaticFile(name=filename, data=asset.data))
+        if filename not in self.static_files:
+            if asset.length > settings.LX_EXPORTER_MULTIPART_CHUNK_SIZE:
+                # Too big to hold in memory; it will be streamed straight to S3 when uploaded.
+                static_file = StaticFile(name=filename, size=asset.length, stream=asset)
+            else:
+                # Memoized assets already hold their data; share it rather than copying it.
+                data = getattr(asset, 'data', None)
+                if data is None:
+                    data = b''.join(asset.stream_data())
+                asset.close()
+                static_file = StaticFile(name=filename, data=data)
+            self.static_files.add(static_file)
+        else:
+            asset.close()
 
     def transform_olx(self, olx_node):
         """
@@ -164,3 +237,52 @@ class XBlockSerializer(object):
             for key in olx_node.attrib.keys():
                 if key not in ('display_name', 'url_name'):
                     log.warn('<vertical> tag attribute "%s" will be ignored after conversion to <unit>', key)
+
+
+class SerializationCache(object):
+    """
+    Bounded cache of XBlockSerializers, so that a block which is part of
+    several of the roots exported in one run (e.g. a vertical that's listed
+    along with its children) is only serialized once.
+
+    Entries are keyed by usage key and block version, and evicted least
+    recently used first once their OLX and static files add up to more than
+    max_bytes. A serialized block doesn't depend on which root it's exported
+    under (the output paths and static file URLs are worked out per root when
+    it's written), so a cached one can be used for any root. Blocks with
+    static files that are streamed rather than held in memory are not cached,
+    since their streams can only be uploaded once.
+    """
+
+    def __init__(self, max_bytes):
+        self._cache = LRUCache(max_bytes, get_size=self._entry_size)
+
+    @staticmethod
+    def _entry_size(data):
+        """
+        How many bytes of memory does a cached XBlockSerializer count as?
+        """
+        return len(data.olx_str) + data.static_files.total_size
+
+    @property
+    def hits(self):
+        """ Number of blocks whose serialization was found in the cache """
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        """ Number of blocks that had to be serialized """
+        return self._cache.misses
+
+    def serialize(self, block, version):
+        """
+        Get the XBlockSerializer of the given version of a block, serializing
+        it only if it's not in the cache.
+        """
+        key = (six.text_type(block.scope_ids.usage_id), version)
+        data = self._cache.get(key)
+        if data is None:
+            data = XBlockSerializer(block)
+            if all(static_file.stream is None for static_file in data.static_files):
+                self._cache.put(key, data)
+        return data
@@ -17,11 +17,18 @@ from __future__ import absolute_import, unicode_literals
 
 import logging
 import re
+from collections import OrderedDict
 
 import six
 
+from .asset_cache import NOT_FOUND, get_asset_memo, get_disk_asset_cache
+from .lru import LRUCache
+
 LOG = logging.getLogger(__name__)
 
+# Course key -> compiled regular expression from _get_static_url_re()
+_static_url_res = LRUCache(max_size=256)
+
 
 class EdXPlatformImportError(ImportError):
     """
@@ -36,6 +43,25 @@ class EdXPlatformImportError(ImportError):
         super(EdXPlatformImportError, self).__init__(message)
 
 
+def reset_connections():
+    """
+    Discard any database, modulestore and contentstore connections, so that
+    new ones are opened on next use. Needed in a forked worker process, which
+    must not share the connections of its parent.
+    """
+    try:
+        from django.db import connections
+        from xmodule.contentstore import django as contentstore_django
+        from xmodule.modulestore.django import clear_existing_modulestores
+    except ImportError as exc:
+        raise EdXPlatformImportError(exc)
+
+    for connection in connections.all():
+        connection.close()
+    clear_existing_modulestores()
+    contentstore_django._CONTENTSTORE.clear()  # pylint: disable=protected-access
+
+
 def get_block(usage_key):
     """
     Return block from the modulestore.
@@ -48,10 +74,110 @@ def get_block(usage_key):
     return store().get_item(usage_key)
 
 
-def get_asset_content_from_path(course_key, asset_path):
+def get_block_tree(usage_key):
+    """
+    Load the given block and all of its descendants from the modulestore.
+
+    The whole subtree is fetched with a single get_item(..., depth=None) call
+    inside a bulk operation for the course, so that walking the children only
+    hits the runtime's cache instead of making one query per block. On split
+    courses, lazy=False makes it load every block's definition up front too
+    (in one query), rather than one at a time when the fields are first read.
+
+    Returns a tuple of (blocks, num_get_item_calls) where blocks is an
+    OrderedDict of usage key -> block, in depth-first order starting with the
+    root, and num_get_item_calls is how many get_item() calls were needed
+    (normally 1; each one makes a few MongoDB queries).
+    """
+    try:
+        from xmodule.modulestore.django import modulestore
+    except ImportError as exc:
+        raise EdXPlatformImportError(exc)
+
+    store = modulestore()
+    blocks = OrderedDict()
+    num_get_item_calls = 0
+    with store.bulk_operations(usage_key.course_key):
+        root = store.get_item(usage_key, depth=None, lazy=False)
+        num_get_item_calls += 1
+        stack = [root]
+        while stack:
+            block = stack.pop()
+            block_key = block.scope_ids.usage_id
+            if block_key in blocks:
+                continue
+            blocks[block_key] = block
+            if block.has_children:
+                children = {child.scope_ids.usage_id: child for child in block.get_children()}
+                for child_id in reversed(block.children):
+                    child = children.get(child_id)
+                    if child is None:
+                        # Not part of the prefetched data (shouldn't normally happen):
+                        child = store.get_item(child_id, depth=None, lazy=False)
+                        num_get_item_calls += 1
+                    stack.append(child)
+    return blocks, num_get_item_calls
+
+
+def get_block_version(block):
+    """
+    Return a string identifying the current version of the given block's
+    fields and children in the modulestore, or None if that can't be
+    determined.
+    """
+    update_version = getattr(block, 'update_version', None)  # Only set by the split modulestore
+    edited_on = getattr(block, 'edited_on', None)
+    if update_version is None and edited_on is None:
+        return None
+    return '{}@{}'.format(update_version, edited_on.isoformat() if edited_on else None)
+
+
+def get_own_metadata(block):
+    """
+    Return a dict of the settings-scoped fields explicitly set on the given
+    block (i.e. not inherited), as their JSON values.
+    """
+    try:
+        from xmodule.modulestore.inheritance import own_metadata
+    except ImportError as exc:
+        raise EdXPlatformImportError(exc)
+
+    return own_metadata(block)
+
+
+def serialize_xml_field(value):
+    """
+    Serialize a field's JSON value into an XML attribute value, the same way
+    XModule XML export does.
+    """
+    try:
+        from xmodule.xml_module import serialize_field
+    except ImportError as exc:
+        raise EdXPlatformImportError(exc)
+
+    return serialize_field(value)
+
+
+def get_youtube_string(block):
+    """
+    Return the 'youtube' attribute that XML export writes for a video block,
+    e.g. '1.00:3_yD_cEKoCk'.
+    """
+    try:
+        from xmodule.video_module.video_utils import create_youtube_string
+    except ImportError as exc:
+        raise EdXPlatformImportError(exc)
+
+    return create_youtube_string(block)
+
+
+def get_asset_content_from_path(course_key, asset_path, as_stream=False):
     """
     Locate the given asset content, load it into memory, and return it.
 
+    If as_stream is True, the content is not loaded into memory; a
+    StaticContentStream is returned instead, whose data can be read in chunks.
+
     Returns None if the asset is not found.
     """
     try:
@@ -64,11 +190,81 @@ def get_asset_content_from_path(course_key, asset_path):
 
     try:
         asset_key = StaticContent.get_asset_key_from_path(course_key, asset_path)
-        return AssetManager.find(asset_key)
+        return AssetManager.find(asset_key, as_stream=as_stream)
     except (ItemNotFoundError, NotFoundError) as exc:
         return None
 
 
+def reopen_asset_stream(content):
+    """
+    Get a copy of the given asset content that can be read from the start
+    again. A contentstore StaticContentStream can only be read once (its
+    stream_data() doesn't seek back to the start), so it's closed and fetched
+    again; cached and memoized assets can be re-read as they are.
+    """
+    try:
+        from xmodule.contentstore.content import StaticContentStream
+        from xmodule.assetstore.assetmgr import AssetManager
+    except ImportError as exc:
+        raise EdXPlatformImportError(exc)
+
+    if not isinstance(content, StaticContentStream):
+        return content
+    content.close()
+    return AssetManager.find(content.location, as_stream=True)
+
+
+def _get_static_url_re(course_id):
+    """
+    Get the compiled regular expression that matches both absolute asset URLs
+    of the given course and quoted '/static/...' references (see
+    rewrite_static_urls_and_find_paths()). Compiled once per course.
+    """
+    course_id = six.text_type(course_id)
+    static_url_re = _static_url_res.get(course_id)
+    if static_url_re is None:
+        course_part = re.escape(course_id.replace('course-v1:', ''))
+        static_url_re = re.compile(
+            # An absolute URL to an asset of this course:
+            r'(?P<absolute>https?://[^/]+/asset-v1:' + course_part +
+            r'\+type@asset\+block@(?P<filename>[\w\-\. \+]+))'
+            # or a quoted /static/ path, like static_replace.replace_static_urls looks for. Drag-and-drop-v2 has
+            #     &quot;/static/blah.png&quot;
+            # so that counts as a quote too:
+            r'|(?P<quote>\\?[\'"]|&quot;)/static/(?P<rest>.*?)(?P=quote)'
+        )
+        _static_url_res.put(course_id, static_url_re)
+    return static_url_re
+
+
+def rewrite_static_urls_and_find_paths(text, course_id):
+    """
+    Convert absolute URLs like
+        https://studio-site.opencraft.hosting/asset-v1:LabXchange+101+2019+type@asset+block@SCI_1.2_Image_.png
+    to the proper
+        /static/SCI_1.2_Image_.png
+    format for consistency and portability, and find the path of every static
+    asset referenced, all in a single scan of the text.
+
+    Returns a tuple of (rewritten text, list of unique static asset paths like
+    '/static/SCI_1.2_Image_.png' in the order they appear).
+    """
+    static_paths = OrderedDict()
+
+    def replace(match):
+        """ Rewrite/record a single match """
+        if match.group('absolute'):
+            path = '/static/' + match.group('filename')
+            static_paths[path] = True
+            return path
+        # Ignore any query string, e.g. '?raw':
+        static_paths['/static/' + match.group('rest').split('?')[0]] = True
+        return match.group(0)
+
+    text = _get_static_url_re(course_id).sub(replace, text)
+    return text, list(static_paths)
+
+
 def rewrite_absolute_static_urls(text, course_id):
     """
     Convert absolute URLs like
@@ -77,32 +273,39 @@ def rewrite_absolute_static_urls(text, course_id):
         /static/SCI_1.2_Image_.png
     format for consistency and portability.
     """
-    course_part = re.escape(six.text_type(course_id).replace('course-v1:', ''))
-    asset_full_url_re = r'https?://[^/]+/asset-v1:' + course_part + '\+type@asset\+block@(?P<filename>[\w\-\. \+]+)'
-    return re.sub(asset_full_url_re, r'/static/\g<filename>', text)
+    return rewrite_static_urls_and_find_paths(text, course_id)[0]
 
 
-def collect_assets_from_text(text, course_id):
+def collect_assets_from_paths(static_paths, course_id):
     """
-    Yield dicts of asset content and path from static asset paths found in the given text.
+    Yield dicts of asset content and path for the given static asset paths,
+    e.g. as found by rewrite_static_urls_and_find_paths().
 
-    Make sure to have replaced the URLs with rewrite_absolute_static_urls first.
+    The content is a StaticContentStream (or, if the on-disk asset cache is
+    enabled, a CachedAsset), so large files aren't loaded into memory
+    until/unless they're actually read. Small files are memoized for the
+    rest of the run as a MemoizedAsset, whose data is shared by every block
+    that uses it.
     """
-    try:
-        from static_replace import replace_static_urls
-    except ImportError as exc:
-        raise EdXPlatformImportError(exc)
-
-    # Replace static urls like '/static/foo.png'
-    static_paths = []
-    # Drag-and-drop-v2 has
-    #     &quot;/static/blah.png&quot;
-    # which must be changed to "/static/blah.png" for replace_static_urls to work:
-    text2 = text.replace("&quot;", '"')
-    replace_static_urls(text=text2, course_id=course_id, static_paths_out=static_paths)
-    for (path, uri) in static_paths:
-        content = get_asset_content_from_path(course_id, path)
+    disk_cache = get_disk_asset_cache()
+    memo = get_asset_memo()
+    for path in static_paths:
+        content = memo.lookup(course_id, path)
         if content is None:
-            LOG.error("Static asset not found: (%s, %s)", path, uri)
+            content = get_asset_content_from_path(course_id, path, as_stream=True)
+            if content is not None and disk_cache:
+                content = disk_cache.wrap(content)
+            content = memo.remember(course_id, path, content)
+        if content is None or content is NOT_FOUND:
+            LOG.error("Static asset not found: (%s, %s)", path, course_id)
         else:
             yield {'content': content, 'path': path}
+
+
+def collect_assets_from_text(text, course_id):
+    """
+    Yield dicts of asset content and path from static asset paths found in the given text.
+
+    See collect_assets_from_paths() for what the content can be.
+    """
+    return collect_assets_from_paths(rewrite_static_urls_and_find_paths(text, course_id)[1], course_id)
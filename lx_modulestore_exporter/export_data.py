@@ -5,47 +5,52 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import json
 import logging
-import os
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.utils.translation import gettext as _
-import boto3
-import botocore
 import six
 
 from . import compat
-from .block_serializer import XBlockSerializer
+from .adapters import export_session
+from .block_serializer import XBlockSerializer, blockstore_def_key_from_modulestore_usage_key
+from .manifest import ExportManifest, hash_olx
+from .olx_rewrite import rewrite_static_urls
+from .olx_storage import OLXDirectory, root_name
+from .s3_storage import AssetUploader, S3ObjectIndex, content_addressed_key, get_s3_bucket
 
 log = logging.getLogger(__name__)
 
 
-# Connect to AWS:
-session = boto3.Session(
-    aws_access_key_id=settings.LX_EXPORTER_AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=settings.LX_EXPORTER_AWS_ACCESS_KEY_SECRET,
+# Summary of what export_data() did for one root
+ExportResult = namedtuple(
+    'ExportResult', ['exported_blocks', 'skipped_blocks', 'static_file_bytes', 'upload_failures'],
 )
-s3 = session.resource('s3')
-s3_bucket = s3.Bucket(settings.LX_EXPORTER_STATIC_FILES_BUCKET)
 
 
-def s3_bucket_has_object(path):
+def olx_filename(block_key, root_block_key):
     """
-    Does our S3 bucket have the specified file/object/key?
+    Get the name of the file that the given block's OLX is written to, within
+    the output directory of root_block_key.
     """
-    try:
-        s3_bucket.Object(path).load()
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            # The object does not exist.
-            return False
-        else:
-            # Something else has gone wrong.
-            raise
-    else:
-        return True
-
-
-def export_data(root_block_key, out_dir):
+    if block_key == root_block_key:
+        return 'definition-1.xml'
+    def_id = blockstore_def_key_from_modulestore_usage_key(block_key)
+    return 'definition-{}.xml'.format(def_id.replace('/', '-'))
+
+
+def export_data(
+    root_block_key,
+    out_dir,
+    s3_index=None,
+    uploader=None,
+    content_addressed=None,
+    force=False,
+    serialize_workers=1,
+    serialization_cache=None,
+    olx_store=None,
+):
     """
     Transfer the given block (and its children) to Blockstore.
 
@@ -54,57 +59,171 @@ def export_data(root_block_key, out_dir):
     * bundle_uuid: UUID of the destination block
     * collection_uuid: UUID of the destination collection
       If no bundle_uuid provided, then a new bundle will be created here and that becomes the destination bundle.
+    * s3_index: S3ObjectIndex of the objects already in our bucket, which can
+      be shared across calls. If not provided, a new one is created.
+    * uploader: AssetUploader used to upload the static files to S3, which
+      can be shared across calls. If not provided, a new one is created.
+    * content_addressed: whether to store static files under a hash of their
+      contents (shared by all roots) rather than under a per-root folder.
+      Defaults to the LX_EXPORTER_CONTENT_ADDRESSED_ASSETS setting.
+    * force: re-export every block, even those that the root's export
+      manifest says are unchanged since the last export.
+    * serialize_workers: number of threads to serialize blocks on, so that
+      one block's serialization can proceed while another is waiting on the
+      modulestore or contentstore.
+    * serialization_cache: SerializationCache of blocks already serialized
+      for other roots in this run, which can be shared across calls. If not
+      provided, every block is serialized.
+    * olx_store: the OLXDirectory or OLXPack to write the OLX to, which can
+      be shared across calls. Defaults to an OLXDirectory in out_dir.
+
+    Returns an ExportResult. Its upload_failures is an OrderedDict of block
+    key -> list of (S3 key, exception) for any static files that failed to
+    upload.
     """
     log.info(root_block_key)
 
-    # Step 1: Serialize the XBlocks to OLX files + static asset files
-
-    serialized_blocks = {}  # Key is each XBlock's original usage key
-
-    def serialize_block(block_key):
-        """ Inner method to recursively serialize an XBlock to OLX """
-        if block_key in serialized_blocks:
-            return
-
-        block = compat.get_block(block_key)
-        serialized_blocks[block_key] = XBlockSerializer(block)
+    if content_addressed is None:
+        content_addressed = settings.LX_EXPORTER_CONTENT_ADDRESSED_ASSETS
 
-        if block.has_children:
-            for child_id in block.children:
-                serialize_block(child_id)
+    if olx_store is None:
+        olx_store = OLXDirectory(out_dir)
+    root = root_name(root_block_key)
 
-    serialize_block(root_block_key)
+    manifest = ExportManifest(olx_store, root, config={
+        'bucket': settings.LX_EXPORTER_STATIC_FILES_BUCKET,
+        'static_files_path': settings.LX_EXPORTER_STATIC_FILES_PATH,
+        'content_addressed': content_addressed,
+    })
 
-    root_block = compat.get_block(root_block_key)
+    # Step 1: Load the whole subtree from the modulestore in one go.
+    # (This holds the XBlocks themselves, but not their OLX or static files.)
 
-    out_dir = os.path.join(out_dir, root_block_key.block_type) + '-' + root_block_key.block_id + '/'
-    if not os.path.isdir(out_dir):
-        os.mkdir(out_dir)
+    blocks, num_get_item_calls = compat.get_block_tree(root_block_key)
+    print(" -> Loaded {} blocks using {} get_item() call(s)".format(len(blocks), num_get_item_calls))
+    manifest.retain_only(blocks.keys())
 
     s3_path_prefix = (
         settings.LX_EXPORTER_STATIC_FILES_PATH + root_block_key.block_type + '-' + root_block_key.block_id + '/'
     )
-    s3_url_prefix = 'https://' + settings.LX_EXPORTER_STATIC_FILES_BUCKET + '/' + s3_path_prefix
-    # For each XBlock that we're exporting:
-    for data in serialized_blocks.values():
-        olx_str = data.olx_str
-
+    s3_url_prefix = 'https://' + settings.LX_EXPORTER_STATIC_FILES_BUCKET + '/'
+    if s3_index is None:
+        s3_index = S3ObjectIndex(get_s3_bucket())
+    own_uploader = uploader is None
+    if own_uploader:
+        uploader = AssetUploader(get_s3_bucket(), s3_index)
+
+    # Step 2: Stream the blocks through a pipeline of
+    #     traverse -> serialize to OLX + static files -> queue uploads -> write OLX
+    # one block at a time. Each block's OLX and static file data is released as
+    # soon as it's been written (and uploaded), and the uploader limits how
+    # much data can be waiting to upload, so that memory use doesn't grow with
+    # the size of the tree.
+
+    def blocks_to_export():
+        """ Yield (block, version) for each block changed since it was last exported """
+        for block_key, block in blocks.items():
+            version = compat.get_block_version(block)
+            if force or not manifest.is_unchanged(block_key, version, olx_filename(block_key, root_block_key)):
+                yield block, version
+
+    def serialize(blocks_and_versions):
+        """
+        Serialize each block to OLX + static asset files, in order. With more
+        than one serialize worker, up to that many blocks are serialized at
+        once on a thread pool.
+        """
+        def serialize_block(block, version):
+            """ Serialize one block, or reuse its serialization from another root """
+            if serialization_cache is not None:
+                return serialization_cache.serialize(block, version)
+            return XBlockSerializer(block)
+
+        if serialize_workers <= 1:
+            for block, version in blocks_and_versions:
+                yield serialize_block(block, version), version
+            return
+        with ThreadPoolExecutor(max_workers=serialize_workers) as executor:
+            pending = deque()  # (Future of XBlockSerializer, version), in order
+            for block, version in blocks_and_versions:
+                pending.append((executor.submit(serialize_block, block, version), version))
+                if len(pending) >= serialize_workers:
+                    future, version = pending.popleft()
+                    yield future.result(), version
+            while pending:
+                future, version = pending.popleft()
+                yield future.result(), version
+
+    def upload_static_files(data):
+        """
+        Queue the upload of a serialized block's static files. Returns a dict of
+        static file name -> (S3 key, size).
+        """
+        uploaded_files = {}
         for asset_file in data.static_files:
-            dest_path = s3_path_prefix + asset_file.name
-            if not s3_bucket_has_object(dest_path):
-                print(" -> Uploading static asset file to S3: {} -> {}".format(asset_file.name, dest_path))
-                s3_bucket.put_object(Key=dest_path, Body=asset_file.data)
+            if content_addressed:
+                dest_path = content_addressed_key(settings.LX_EXPORTER_STATIC_FILES_PATH, asset_file)
+                # List the shard folder that this file would be in, in case an earlier run uploaded it:
+                s3_index.load_prefix(dest_path[:dest_path.rindex('/') + 1])
             else:
-                print(" -> already uploaded static asset {}".format(asset_file.name))
-            dest_url = s3_url_prefix + asset_file.name
-            olx_str = olx_str.replace('/static/' + asset_file.name, dest_url)
-        
-        if data.orig_block_key == root_block_key:
-            olx_path = out_dir + 'definition-1.xml'
+                dest_path = s3_path_prefix + asset_file.name
+                # List what's already been uploaded for this root, rather than checking each file:
+                s3_index.load_prefix(s3_path_prefix)
+            # The upload happens in the background; we can write the OLX in the meantime.
+            uploader.submit(data.orig_block_key, asset_file, dest_path)
+            uploaded_files[asset_file.name] = (dest_path, asset_file.size)
+        return uploaded_files
+
+    def write_olx(data, uploaded_files):
+        """
+        Write out a serialized block's OLX, pointing to the new URLs of its
+        static files. Returns a tuple of (OLX filename, hash of the OLX).
+        """
+        url_map = {name: s3_url_prefix + dest_path for name, (dest_path, _size) in uploaded_files.items()}
+        olx_str, unresolved = rewrite_static_urls(data.olx_str, url_map)
+        for url in unresolved:
+            print(" -> Unresolved static file reference in {}: {}".format(data.orig_block_key, url))
+
+        filename = olx_filename(data.orig_block_key, root_block_key)
+        olx_bytes = olx_str.encode('utf-8')
+        olx_store.write(root, filename, olx_bytes)
+        return filename, hash_olx(olx_bytes)
+
+    # Block key -> (version, OLX filename, OLX hash, static files) of each block that we export:
+    exported = OrderedDict()
+    static_file_bytes = 0
+    with export_session():
+        for data, version in serialize(blocks_to_export()):
+            uploaded_files = upload_static_files(data)
+            filename, olx_hash = write_olx(data, uploaded_files)
+            exported[data.orig_block_key] = (version, filename, olx_hash, uploaded_files)
+            static_file_bytes += data.static_files.total_size
+    skipped_blocks = len(blocks) - len(exported)
+
+    # Wait for this root's static files to finish uploading:
+    failures = uploader.wait(exported.keys())
+    if own_uploader:
+        uploader.shutdown()
+    for block_key, block_failures in failures.items():
+        for dest_path, exc in block_failures:
+            print(" -> Failed to upload static asset {} for {}: {}".format(dest_path, block_key, exc))
+
+    # Update the manifest, except for blocks that need to be retried next time:
+    for block_key, (version, filename, olx_hash, uploaded_files) in exported.items():
+        if block_key in failures:
+            manifest.forget(block_key)
         else:
-            olx_path = out_dir + 'definition-{}.xml'.format(data.def_id.replace('/', '-'))
-        with open(olx_path, 'wb') as fh:
-            log.info(" -> " + olx_path)
-            fh.write(olx_str.encode('utf-8'))
+            manifest.record(block_key, version, filename, olx_hash, uploaded_files)
+    manifest.save()
+    olx_store.flush()
+    print(" -> Re-exported {} blocks ({} bytes of static files), skipped {} unchanged blocks".format(
+        len(exported), static_file_bytes, skipped_blocks,
+    ))
 
     log.info("  ")
+    return ExportResult(
+        exported_blocks=len(exported),
+        skipped_blocks=skipped_blocks,
+        static_file_bytes=static_file_bytes,
+        upload_failures=failures,
+    )
@@ -0,0 +1,201 @@
+"""
+Fast serializers that build the OLX of our most common block types directly
+from their field data.
+
+The generic path in XBlockSerializer sets up an export filesystem and calls
+the block's add_xml_to_node(), then checks which files it wrote. For the
+types below that machinery is unnecessary (they never write any files, or
+we can tell when they would), so we build the same OLX element ourselves.
+A fast serializer returns None whenever a block needs something it doesn't
+handle, in which case the generic path is used instead.
+
+Use the verify_fast_serializers management command to check that these
+produce the same OLX as the generic path for real content.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import copy
+import json
+
+import six
+from lxml import etree
+from xblock.mixins import XmlSerializationMixin
+from xmodule.xml_module import XmlParserMixin
+
+from . import compat
+
+# Block type -> function(block) that returns its OLX as an etree Element, or None
+FAST_SERIALIZERS = {}
+
+
+def fast_serializer(*block_types):
+    """
+    Decorator to register a function as the fast serializer of the given block types.
+    """
+    def register(func):
+        for block_type in block_types:
+            FAST_SERIALIZERS[block_type] = func
+        return func
+    return register
+
+
+def serialize_block_fast(block):
+    """
+    Build the OLX element of the given block with its type's fast
+    serializer, without its children (as XBlockSerializer needs).
+
+    Returns None if there is no fast serializer for this type, or it can't
+    handle this particular block.
+    """
+    serializer = FAST_SERIALIZERS.get(block.scope_ids.block_type)
+    if serializer is None or _has_asides_to_export(block):
+        return None
+    return serializer(block)
+
+
+def canonical_olx(olx_node):
+    """
+    Get a canonical form of the given OLX element for comparing with another,
+    ignoring attribute order and whitespace-only text.
+    """
+    olx_node = copy.deepcopy(olx_node)
+    for node in olx_node.iter():
+        if node.text is not None and not node.text.strip():
+            node.text = None
+        if node.tail is not None and not node.tail.strip():
+            node.tail = None
+    olx_node.tail = None
+    return etree.tostring(olx_node, method='c14n')
+
+
+def _has_asides_to_export(block):
+    """
+    Does the given block have any XBlockAsides whose data would be exported with it?
+    """
+    get_asides = getattr(block.runtime, 'get_asides', None)
+    return bool(get_asides) and any(aside.needs_serialization() for aside in get_asides(block))
+
+
+def _inherits_add_xml_to_node(block, mixin):
+    """
+    Does the given block use mixin.add_xml_to_node() as is? If its class
+    overrides it, our fast serializer would not be equivalent.
+    """
+    return (
+        six.get_unbound_function(type(block).add_xml_to_node) is
+        six.get_unbound_function(mixin.add_xml_to_node)
+    )
+
+
+def _finish_xmodule_node(block, xml_object):
+    """
+    Add the metadata to the element returned by a block's definition_to_xml(),
+    as XmlParserMixin.add_xml_to_node() does.
+    """
+    not_to_clean = getattr(block, 'metadata_to_not_to_clean', {}).get(block.category, ())
+    for attr in block.metadata_attributes:
+        if attr not in not_to_clean:
+            xml_object.attrib.pop(attr, None)
+    xml_object.tag = block.category
+    # Add the non-inherited metadata
+    for attr, value in sorted(compat.get_own_metadata(block).items()):
+        if (attr not in block.metadata_to_strip and attr not in block.metadata_to_export_to_policy and
+                attr not in not_to_clean):
+            xml_object.set(attr, compat.serialize_xml_field(value))
+    for key, value in block.xml_attributes.items():
+        if key not in block.metadata_to_strip:
+            xml_object.set(key, compat.serialize_xml_field(value))
+    xml_object.set('url_name', block.url_name)
+    return xml_object
+
+
+@fast_serializer('problem')
+def serialize_problem(block):
+    """
+    A problem's definition is its XML, stored in 'data'.
+    """
+    if not _inherits_add_xml_to_node(block, XmlParserMixin):
+        return None
+    try:
+        xml_object = etree.fromstring(block.data)
+    except (etree.XMLSyntaxError, ValueError):
+        return None  # Let the generic path report the problem
+    return _finish_xmodule_node(block, xml_object)
+
+
+@fast_serializer('vertical')
+def serialize_vertical(block):
+    """
+    A vertical's definition is just its children, which we don't include.
+    """
+    if not _inherits_add_xml_to_node(block, XmlParserMixin):
+        return None
+    return _finish_xmodule_node(block, etree.Element('vertical'))
+
+
+@fast_serializer('video')
+def serialize_video(block):
+    """
+    Build a video's definition as VideoBlock.definition_to_xml() does. Videos
+    with an edx_video_id are left to the generic path, since their
+    transcripts and encodings are exported from VAL.
+    """
+    if not _inherits_add_xml_to_node(block, XmlParserMixin):
+        return None
+    if (block.edx_video_id or '').strip():
+        return None
+    xml_object = etree.Element('video')
+    youtube_string = compat.get_youtube_string(block)
+    # (Matching definition_to_xml(): the default youtube ID is not written out)
+    if youtube_string and youtube_string != '1.00:3_yD_cEKoCk':
+        xml_object.set('youtube', six.text_type(youtube_string))
+    xml_object.set('url_name', block.url_name)
+    attrs = {
+        'display_name': block.display_name,
+        'show_captions': json.dumps(block.show_captions),
+        'start_time': block.start_time,
+        'end_time': block.end_time,
+        'sub': block.sub,
+        'download_track': json.dumps(block.download_track),
+        'download_video': json.dumps(block.download_video),
+    }
+    for key, value in attrs.items():
+        if value and key in block.fields and block.fields[key].is_set_on(block):
+            xml_object.set(key, six.text_type(value))
+    for source in block.html5_sources:
+        etree.SubElement(xml_object, 'source', src=source)
+    if block.track:
+        etree.SubElement(xml_object, 'track', src=block.track)
+    if block.handout:
+        etree.SubElement(xml_object, 'handout', src=block.handout)
+    transcripts = block.transcripts or {}
+    for language in sorted(transcripts):
+        etree.SubElement(xml_object, 'transcript', language=language, src=transcripts[language])
+    if getattr(block, 'license', None):
+        xml_object.set('license', block.license)
+    return _finish_xmodule_node(block, xml_object)
+
+
+@fast_serializer('drag-and-drop-v2')
+def serialize_xblock_fields(block):
+    """
+    Build the OLX of a pure XBlock as XmlSerializationMixin.add_xml_to_node()
+    does: each field that's set becomes an attribute.
+    """
+    if block.has_children or not _inherits_add_xml_to_node(block, XmlSerializationMixin):
+        return None
+    node = etree.Element(block.xml_element_name())
+    node.set('xblock-family', block.entry_point)
+    for field_name, field in block.fields.items():
+        if field_name in ('children', 'parent', 'content'):
+            continue
+        if not (field.is_set_on(block) or getattr(field, 'force_export', False)):
+            continue
+        value = field.to_string(field.read_from(block))
+        if getattr(field, 'xml_node', False) or (value is None and getattr(field, 'none_to_xml', False)):
+            return None  # Needs a child element in the 'option' namespace; leave it to the generic path
+        node.set(field_name, '' if value is None else value)
+    text = block.xml_text_content()
+    if text is not None:
+        node.text = text
+    return node
@@ -0,0 +1,60 @@
+"""
+A simple size-bounded LRU cache
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping that evicts its least recently used entries once the
+    total size of its values exceeds max_size.
+
+    get_size(value) gives the size of each value (e.g. in bytes); by default
+    every value has a size of 1, so max_size is the maximum number of entries.
+    """
+
+    def __init__(self, max_size, get_size=None):
+        self.max_size = max_size
+        self.get_size = get_size or (lambda value: 1)
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # Key -> (value, size), least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Get the value for 'key', or 'default' if it's not in the cache.
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)  # Move to the most recently used end
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Store 'value' for 'key', evicting older entries if needed. Values that
+        are too big for the cache on their own are not stored.
+        """
+        size = self.get_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.total_size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.total_size += size
+            while self.total_size > self.max_size:
+                _old_key, (_old_value, old_size) = self._entries.popitem(last=False)
+                self.total_size -= old_size
@@ -0,0 +1,69 @@
+"""
+Convert exported OLX between the "dir" (one file per block) and "pack"
+(single pack file) output formats
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from .export_block import dir_path
+from ...olx_storage import OUTPUT_FORMATS, open_olx_store
+
+
+class Command(BaseCommand):
+    """
+    convert_olx management command.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.help = __doc__
+        self.args = {}
+
+    def add_arguments(self, parser):
+        """
+        Add named arguments.
+        """
+        self.args['olx_dir'] = parser.add_argument(
+            '--olx-dir',
+            type=dir_path,
+            default='/edx/src/lx-modulestore-exporter/out',
+            help='Directory to find the OLX to convert'
+        )
+        self.args['from_format'] = parser.add_argument(
+            '--from-format',
+            choices=OUTPUT_FORMATS,
+            required=True,
+            help='Format of the existing OLX'
+        )
+        self.args['to_format'] = parser.add_argument(
+            '--to-format',
+            choices=OUTPUT_FORMATS,
+            required=True,
+            help='Format to convert the OLX to'
+        )
+        self.args['out_dir'] = parser.add_argument(
+            '--out-dir',
+            type=dir_path,
+            default=None,
+            help='Directory to put the converted OLX (default: the same as --olx-dir)'
+        )
+
+    def handle(self, *args, **options):
+        """
+        Copy every file of every root from one store to the other.
+        """
+        out_dir = options['out_dir'] or options['olx_dir']
+        if options['from_format'] == options['to_format'] and out_dir == options['olx_dir']:
+            raise CommandError('Nothing to do: the OLX is already in that format')
+        source = open_olx_store(options['olx_dir'], options['from_format'])
+        dest = open_olx_store(out_dir, options['to_format'])
+
+        num_roots = num_files = 0
+        for root in source.roots():
+            for filename in source.filenames(root):
+                dest.write(root, filename, source.read(root, filename))
+                num_files += 1
+            dest.flush()  # Once per root, as export_data() does
+            num_roots += 1
+        print("Converted {} files of {} roots".format(num_files, num_roots))
@@ -12,7 +12,8 @@ from django.core.management.base import BaseCommand
 from opaque_keys import InvalidKeyError
 from opaque_keys.edx.keys import UsageKey
 
-from ...export_data import export_data
+from ...olx_storage import OUTPUT_FORMATS, open_olx_store
+from ...s3_storage import AssetUploader, S3ObjectIndex, get_s3_bucket
 
 
 def dir_path(string):
@@ -52,6 +53,43 @@ class Command(BaseCommand):
             default='/edx/src/lx-modulestore-exporter/out',
             help='Directory to put the OLX output files'
         )
+        self.args['output_format'] = parser.add_argument(
+            '--output-format',
+            choices=OUTPUT_FORMATS,
+            default='dir',
+            help='Write the OLX as one file per block in a directory per root ("dir"), '
+                 'or append it all to a single pack file in the output directory ("pack")'
+        )
+        self.args['serialize_workers'] = parser.add_argument(
+            '--serialize-workers',
+            type=int,
+            default=1,
+            help='Number of threads to serialize the blocks of each root with'
+        )
+        self.args['upload_workers'] = parser.add_argument(
+            '--upload-workers',
+            type=int,
+            default=8,
+            help='Number of threads to use for uploading static asset files to S3'
+        )
+        self.args['max_inflight_bytes'] = parser.add_argument(
+            '--max-inflight-bytes',
+            type=int,
+            default=256 * 1024 * 1024,
+            help='Maximum amount of static asset data to hold in memory while waiting for it to upload to S3'
+        )
+        self.args['content_addressed'] = parser.add_argument(
+            '--content-addressed',
+            action='store_true',
+            default=None,
+            help='Store static asset files under a hash of their contents, so identical files are only uploaded once '
+                 '(default: the LX_EXPORTER_CONTENT_ADDRESSED_ASSETS setting)'
+        )
+        self.args['force'] = parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-export every block, even those the export manifest says are unchanged since the last export'
+        )
 
     def handle(self, *args, **options):
         """
@@ -62,8 +100,31 @@ class Command(BaseCommand):
             block_key = UsageKey.from_string(options['block_key'])
         except InvalidKeyError:
             raise ArgumentError(message='Invalid block usage key', argument=self.args['block_key'])
- 
-        export_data(root_block_key=block_key, out_dir=options['out_dir'])
+        # Imported here rather than at the top, since it pulls in the XBlock
+        # runtime, lxml etc. which other commands that use dir_path() don't need:
+        from ...export_data import export_data
+
+        s3_bucket = get_s3_bucket()
+        s3_index = S3ObjectIndex(s3_bucket)
+        uploader = AssetUploader(
+            s3_bucket,
+            s3_index,
+            max_workers=options['upload_workers'],
+            max_inflight_bytes=options['max_inflight_bytes'],
+        )
+        try:
+            export_data(
+                root_block_key=block_key,
+                out_dir=options['out_dir'],
+                s3_index=s3_index,
+                uploader=uploader,
+                content_addressed=options['content_addressed'],
+                force=options['force'],
+                serialize_workers=options['serialize_workers'],
+                olx_store=open_olx_store(options['out_dir'], options['output_format']),
+            )
+        finally:
+            uploader.shutdown()
 
     def set_logging(self, verbosity):
         """
@@ -3,17 +3,136 @@ Export multiple blocks and their children as OLX. Reads
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import functools
 import logging
+import multiprocessing
 import os
 from argparse import ArgumentError
+from collections import OrderedDict
 from uuid import UUID
 
+import six
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from opaque_keys import InvalidKeyError
 from opaque_keys.edx.keys import UsageKey
 
 from .export_block import dir_path
+from ... import compat
+from ...asset_cache import get_asset_memo, get_disk_asset_cache
+from ...block_serializer import SerializationCache
 from ...export_data import export_data
+from ...olx_storage import OUTPUT_FORMATS, open_olx_store
+from ...s3_storage import AssetUploader, S3ObjectIndex, get_s3_bucket
+from ...work_queue import WorkQueue, in_shard, shard_spec
+
+log = logging.getLogger(__name__)
+
+# State shared by all of the roots exported by this process; see init_export_process()
+_process_state = {}
+
+
+def init_export_process(options, reset_connections=False):
+    """
+    Set up this process for exporting roots with export_root().
+
+    The index of already-uploaded S3 objects, the upload threads, the OLX
+    store and the cache of serialized blocks are shared across all of the
+    roots that the process exports. When running as a worker of a process
+    pool, reset_connections should be True so that the worker opens its own
+    database/modulestore connections rather than sharing the ones it
+    inherited from its parent.
+    """
+    if reset_connections:
+        compat.reset_connections()
+    s3_bucket = get_s3_bucket()
+    s3_index = S3ObjectIndex(s3_bucket)
+    _process_state['options'] = options
+    _process_state['s3_index'] = s3_index
+    _process_state['uploader'] = AssetUploader(
+        s3_bucket,
+        s3_index,
+        max_workers=options['upload_workers'],
+        max_inflight_bytes=options['max_inflight_bytes'],
+    )
+    _process_state['olx_store'] = open_olx_store(options['out_dir'], options['output_format'])
+    _process_state['serialization_cache'] = SerializationCache(settings.LX_EXPORTER_SERIALIZATION_CACHE_MAX_BYTES)
+
+
+def process_counters():
+    """
+    Get the current values of this process's performance counters.
+    """
+    memo = get_asset_memo()
+    counters = {
+        's3_requests': _process_state['s3_index'].num_requests,
+        'asset_memo_hits': memo.hits,
+        'asset_memo_misses': memo.misses,
+        'serialization_cache_hits': _process_state['serialization_cache'].hits,
+        'serialization_cache_misses': _process_state['serialization_cache'].misses,
+    }
+    disk_cache = get_disk_asset_cache()
+    if disk_cache:
+        counters['asset_cache_hits'] = disk_cache.hits
+        counters['asset_cache_misses'] = disk_cache.misses
+    return counters
+
+
+def export_root(block_key_str):
+    """
+    Export one root using the state set up by init_export_process().
+
+    Returns a tuple of (block_key_str, ExportResult or None, error message or
+    None, dict of how much each of the process_counters() went up by). The
+    result only contains plain data (upload errors are converted to strings)
+    so it can be sent back from a worker process.
+    """
+    options = _process_state['options']
+    counters_before = process_counters()
+    print(block_key_str)
+    try:
+        result = export_data(
+            root_block_key=UsageKey.from_string(block_key_str),
+            out_dir=options['out_dir'],
+            s3_index=_process_state['s3_index'],
+            uploader=_process_state['uploader'],
+            content_addressed=options['content_addressed'],
+            force=options['force'],
+            serialize_workers=options['serialize_workers'],
+            serialization_cache=_process_state['serialization_cache'],
+            olx_store=_process_state['olx_store'],
+        )
+    except Exception as exc:  # pylint: disable=broad-except
+        log.exception("Failed to export %s", block_key_str)
+        result = None
+        error = "{}: {}".format(type(exc).__name__, exc)
+    else:
+        upload_failures = OrderedDict(
+            (six.text_type(block_key), [(dest_path, six.text_type(exc)) for dest_path, exc in block_failures])
+            for block_key, block_failures in result.upload_failures.items()
+        )
+        result = result._replace(upload_failures=upload_failures)
+        error = None
+    counters = {key: value - counters_before[key] for key, value in process_counters().items()}
+    return block_key_str, result, error, counters
+
+
+def start_export_root(pool, block_key_str):
+    """
+    Start exporting a root claimed from a WorkQueue, on the given pool or (if
+    it's None) in this process when the result is waited for. Returns a
+    function that waits for it, as WorkQueue.run() expects.
+    """
+    if pool:
+        get_outcome = pool.apply_async(export_root, (block_key_str,)).get
+    else:
+        get_outcome = functools.partial(export_root, block_key_str)
+
+    def wait():
+        """ Get the export_root() result, and its error message if any """
+        outcome = get_outcome()
+        return outcome, outcome[2]
+    return wait
 
 
 class Command(BaseCommand):
@@ -44,6 +163,69 @@ class Command(BaseCommand):
             default='/edx/src/lx-modulestore-exporter/out',
             help='Directory to put the OLX output files'
         )
+        self.args['output_format'] = parser.add_argument(
+            '--output-format',
+            choices=OUTPUT_FORMATS,
+            default='dir',
+            help='Write the OLX as one file per block in a directory per root ("dir"), '
+                 'or append it all to a single pack file in the output directory ("pack")'
+        )
+        self.args['serialize_workers'] = parser.add_argument(
+            '--serialize-workers',
+            type=int,
+            default=1,
+            help='Number of threads to serialize the blocks of each root with'
+        )
+        self.args['upload_workers'] = parser.add_argument(
+            '--upload-workers',
+            type=int,
+            default=8,
+            help='Number of threads to use for uploading static asset files to S3'
+        )
+        self.args['max_inflight_bytes'] = parser.add_argument(
+            '--max-inflight-bytes',
+            type=int,
+            default=256 * 1024 * 1024,
+            help='Maximum amount of static asset data to hold in memory while waiting for it to upload to S3'
+        )
+        self.args['content_addressed'] = parser.add_argument(
+            '--content-addressed',
+            action='store_true',
+            default=None,
+            help='Store static asset files under a hash of their contents, so identical files are only uploaded once '
+                 '(default: the LX_EXPORTER_CONTENT_ADDRESSED_ASSETS setting)'
+        )
+        self.args['force'] = parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-export every block, even those the export manifest says are unchanged since the last export'
+        )
+        self.args['workers'] = parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes to export roots with. Each one has its own modulestore connections.'
+        )
+        self.args['shard'] = parser.add_argument(
+            '--shard',
+            type=shard_spec,
+            default=None,
+            help='Only export the roots in shard i of N, e.g. "0/4" on one host, "1/4" on another and so on. '
+                 'Roots are assigned to shards by a hash of their key.'
+        )
+        self.args['queue'] = parser.add_argument(
+            '--queue',
+            type=str,
+            default=None,
+            help='SQLite file to use as a work queue, which several processes or hosts can claim roots from. '
+                 'The roots in the ID file (or shard) are added to it if they are not in it already.'
+        )
+        self.args['lease_seconds'] = parser.add_argument(
+            '--lease-seconds',
+            type=int,
+            default=3600,
+            help='How long a root claimed from the --queue may take before other processes can claim it again'
+        )
 
     def handle(self, *args, **options):
         """
@@ -53,11 +235,104 @@ class Command(BaseCommand):
 
         with open(options['id_file'], 'r') as id_fh:
             block_key_list = [line.split()[0] for line in id_fh.readlines() if line.strip() and line.strip()[0] != '#']
+        block_key_list = [key for key in block_key_list if in_shard(key, options['shard'])]
+        work_queue = None
+        if options['queue']:
+            work_queue = WorkQueue(options['queue'], lease_seconds=options['lease_seconds'])
+            work_queue.add((block_key_str, None) for block_key_str in block_key_list)
+
+        export_options = {
+            key: options[key]
+            for key in (
+                'out_dir', 'output_format', 'serialize_workers', 'upload_workers', 'max_inflight_bytes',
+                'content_addressed', 'force',
+            )
+        }
+        if options['workers'] > 1:
+            pool = multiprocessing.Pool(
+                processes=options['workers'],
+                initializer=init_export_process,
+                initargs=(export_options, True),
+            )
+        else:
+            pool = None
+            init_export_process(export_options)
+        if work_queue:
+            # Claim roots as workers become free:
+            results = (
+                outcome for _key, _data, outcome in
+                work_queue.run(lambda key, _data: start_export_root(pool, key), window=options['workers'])
+            )
+        elif pool:
+            # imap() returns the results in the same order as the ID list:
+            results = pool.imap(export_root, block_key_list)
+        else:
+            results = (export_root(block_key_str) for block_key_str in block_key_list)
+
+        failed_roots = []  # List of (block key, error message) for any roots that couldn't be exported
+        upload_failures = []  # List of (block key, S3 key) for any static files that couldn't be uploaded
+        exported_roots = skipped_roots = exported_blocks = skipped_blocks = static_file_bytes = 0
+        counters = {}  # Totals of the process_counters() of every process
+
+        finished = False
+        try:
+            for block_key_str, result, error, root_counters in results:
+                for key, value in root_counters.items():
+                    counters[key] = counters.get(key, 0) + value
+                if error:
+                    failed_roots.append((block_key_str, error))
+                    continue
+                if result.exported_blocks:
+                    exported_roots += 1
+                else:
+                    skipped_roots += 1
+                exported_blocks += result.exported_blocks
+                skipped_blocks += result.skipped_blocks
+                static_file_bytes += result.static_file_bytes
+                for failed_block_key, block_failures in result.upload_failures.items():
+                    upload_failures.extend((failed_block_key, dest_path) for dest_path, _exc in block_failures)
+            finished = True
+        finally:
+            if pool:
+                if finished:
+                    pool.close()
+                else:
+                    # Interrupted (e.g. Ctrl-C, which also kills the tasks running in the workers, so they'd
+                    # never return), or something went wrong: don't wait for the remaining roots.
+                    pool.terminate()
+                pool.join()
+            else:
+                _process_state['uploader'].shutdown()
 
-        for block_key_str in block_key_list:
-            print(block_key_str)
-            block_key = UsageKey.from_string(block_key_str)
-            export_data(root_block_key=block_key, out_dir=options['out_dir'])
+        print("Re-exported {} roots ({} blocks), skipped {} unchanged roots ({} unchanged blocks in total)".format(
+            exported_roots, exported_blocks, skipped_roots, skipped_blocks,
+        ))
+        print("Exported {} bytes of static files".format(static_file_bytes))
+        print("Made {} S3 list/HEAD requests to check for existing static assets".format(
+            counters.get('s3_requests', 0),
+        ))
+        print("Asset memo: {} hits, {} misses".format(
+            counters.get('asset_memo_hits', 0), counters.get('asset_memo_misses', 0),
+        ))
+        print("Serialization cache: {} blocks reused from other roots, {} serialized".format(
+            counters.get('serialization_cache_hits', 0), counters.get('serialization_cache_misses', 0),
+        ))
+        if 'asset_cache_hits' in counters:
+            print("Asset cache: {} hits, {} misses".format(
+                counters['asset_cache_hits'], counters['asset_cache_misses'],
+            ))
+        if upload_failures:
+            print("\n\nThe following static asset files could not be uploaded:")
+            for failed_block_key, dest_path in upload_failures:
+                print("{} {}".format(failed_block_key, dest_path))
+        if failed_roots:
+            print("\n\nThe following roots could not be exported:")
+            for block_key_str, error in failed_roots:
+                print("{} {}".format(block_key_str, error))
+        if work_queue:
+            print("\nWork queue: {}".format(", ".join(
+                "{} {}".format(count, state) for state, count in sorted(work_queue.counts().items())
+            )))
 
     def set_logging(self, verbosity):
         """
@@ -6,7 +6,10 @@ from __future__ import absolute_import, print_function, unicode_literals
 import logging
 import os
 import re
+import threading
 from argparse import ArgumentError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from uuid import UUID
 
 from django.conf import settings
@@ -19,8 +22,10 @@ from requests.exceptions import HTTPError
 import six
 
 from .export_block import dir_path
-from ...export_data import export_data
-from ...studio_client import StudioClient
+from ...manifest import PushManifest, hash_olx
+from ...olx_storage import OUTPUT_FORMATS, open_olx_store, root_name
+from ...studio_client import BatchedLibraryCommits, StudioClient
+from ...work_queue import WorkQueue, in_shard, shard_spec
 
 
 class Command(BaseCommand):
@@ -35,6 +40,14 @@ class Command(BaseCommand):
         self.logger = logging.getLogger()
         self.args = {}
         self.studio_client = None
+        self.library_commits = None
+        self.push_manifest = None
+        self.verify_remote = False
+        self.olx_store = None
+        self.executor = None  # ThreadPoolExecutor used to push items from a --queue concurrently
+        self.library_tails = {}  # Library key -> Future of the last item of that library given to self.executor
+        self.stopping = threading.Event()  # Set to make worker threads stop before their next item
+        self.workers_running = False  # True while we're waiting for worker threads to stop
 
     def add_arguments(self, parser):
         """
@@ -52,107 +65,323 @@ class Command(BaseCommand):
             default='/edx/src/lx-modulestore-exporter/out',
             help='Directory to find the OLX input files'
         )
+        self.args['input_format'] = parser.add_argument(
+            '--input-format',
+            choices=OUTPUT_FORMATS,
+            default='dir',
+            help='Whether the OLX was exported with --output-format "dir" (the default) or "pack"'
+        )
         self.args['cms_domain'] = parser.add_argument(
             '--cms-domain',
             type=str,
             required=True,
             help='CMS domain, e.g. studio.edx.org'
         )
+        self.args['concurrency'] = parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='Number of items to push at once. Items in the same library are still pushed one at a time, '
+                 'in order, so this helps when the ID list covers several libraries.'
+        )
+        self.args['commit_every'] = parser.add_argument(
+            '--commit-every',
+            type=int,
+            default=100,
+            help='Commit the changes to a library once it has this many uncommitted changes'
+        )
+        self.args['commit_interval'] = parser.add_argument(
+            '--commit-interval',
+            type=float,
+            default=300,
+            help='Commit the changes to a library when it next changes, if its oldest uncommitted change is older '
+                 'than this many seconds. Any remaining changes are committed at the end of the run.'
+        )
+        self.args['push_manifest'] = parser.add_argument(
+            '--push-manifest',
+            type=str,
+            default=None,
+            help='File recording what has been pushed to this Studio instance, so that unchanged blocks can be '
+                 'skipped (default: push-manifest-<cms domain>.json in the --olx-dir)'
+        )
+        self.args['verify_remote'] = parser.add_argument(
+            '--verify-remote',
+            action='store_true',
+            help="Compare each block's OLX with what's in Studio, even if the push manifest says it's unchanged"
+        )
+        self.args['shard'] = parser.add_argument(
+            '--shard',
+            type=shard_spec,
+            default=None,
+            help='Only push the items in shard i of N, e.g. "0/4" on one host, "1/4" on another and so on. '
+                 'Items are assigned to shards by a hash of their modulestore key.'
+        )
+        self.args['queue'] = parser.add_argument(
+            '--queue',
+            type=str,
+            default=None,
+            help='SQLite file to use as a work queue, which several processes or hosts can claim items from. '
+                 'The items in the ID file (or shard) are added to it if they are not in it already.'
+        )
+        self.args['lease_seconds'] = parser.add_argument(
+            '--lease-seconds',
+            type=int,
+            default=600,
+            help='How long an item claimed from the --queue may take before other processes can claim it again'
+        )
 
     def handle(self, *args, **options):
         """
         Validate the arguments, and start the transfer.
         """
         self.set_logging(options['verbosity'])
+        self.olx_store = open_olx_store(options['olx_dir'], options['input_format'])
 
         # Create an API client for interacting with Studio:
         self.studio_client = StudioClient(
             studio_url='https://' + options['cms_domain'],
             config=settings.LX_EXPORTER_CMS_TARGETS[options['cms_domain']],
+            pool_size=max(options['concurrency'], 1) + 1,  # Plus one for the main thread
         )
 
         # Verify that we can connect to Studio:
         response = self.studio_client.api_call('get', '/api/user/v1/me')
         print("Connecting to studio as {}".format(response["username"]))
+        self.push_manifest = PushManifest(options['push_manifest'] or os.path.join(
+            options['olx_dir'], 'push-manifest-{}.json'.format(options['cms_domain']),
+        ))
+        self.verify_remote = options['verify_remote']
+        self.library_commits = BatchedLibraryCommits(
+            self.studio_client,
+            max_changes=options['commit_every'],
+            max_seconds=options['commit_interval'],
+            on_commit=self.push_manifest.confirm_library,
+        )
 
         # Read in the list of IDs (each line is an old modulestore ID and the new blockstore ID)
         with open(options['id_file'], 'r') as id_fh:
             block_key_list = [line.split() for line in id_fh.readlines() if line.strip() and line.strip()[0] != '#']
+        block_key_list = [item for item in block_key_list if in_shard(item[0], options['shard'])]
 
-        unhandled_items = [] # List of tuples of (old_key, new_key) for any items we can't do automatically
+        unhandled_items = []  # List of tuples of (old_key, new_key) for any items we can't do automatically
 
         # Upload the OLX file by file:
-        for old_key_str, new_key_str in block_key_list:
-            old_key = UsageKey.from_string(old_key_str)
-            new_key = UsageKey.from_string(new_key_str)
-            print("Processing {} ({})".format(old_key, new_key))
-
-            olx_dir = os.path.join(options["olx_dir"], old_key.block_type + "-" + old_key.block_id)
-
-            # Various cases:
-            if old_key.block_type == 'vertical':
-                # This is a vertical block. What kind of children does it have?
-
-                def read_olx(filename):
-                    with open(olx_dir + '/' + filename, 'r') as fh:
-                        return fh.read()
-
-                vertical_olx_str = read_olx('definition-1.xml')
-                olx_root = etree.fromstring(vertical_olx_str)
-                children_refs = [node.attrib["definition"] for node in olx_root.iter("xblock-include")]
-                if len(children_refs) == 1:
-                    # This vertical actually contains only a single block:
-                    old_block_type, old_block_id = children_refs[0].split("/")
-                    result = self.convert_and_upload_olx_file(
-                        olx_dir, "definition-{}-{}.xml".format(old_block_type, old_block_id), old_block_type, new_key,
-                    )
-                    if not result:
-                        unhandled_items.append((old_key, new_key))
-                elif new_key.block_type == 'unit':
-                    # Upload each child OLX:
-                    worked = True
-                    for child_ref in children_refs:
-                        child_block_type, child_block_id = child_ref.split("/")
-                        child_new_key = LibraryUsageLocatorV2(
-                            lib_key=new_key.lib_key,
-                            block_type=child_block_type,
-                            usage_id=child_block_id,
-                        )
-                        if self.studio_client.get_library_block(child_new_key) is None:
-                            # Before we can upload the OLX we have to create the child block:
-                            self.studio_client.add_block_to_library(
-                                child_new_key.lib_key,
-                                child_block_type,
-                                child_block_id,
-                                parent_block=new_key,
-                            )
-                        # Now update the OLX of the child block:
-                        result = self.convert_and_upload_olx_file(
-                            olx_dir,
-                            "definition-{}-{}.xml".format(child_block_type, child_block_id),
-                            child_block_type,
-                            child_new_key,
-                        )
-                        worked = worked and result
-                    if worked:
-                        self.set_block_olx(new_key, vertical_olx_str)
-                    else:
-                        unhandled_items.append((old_key, new_key))
-                else:
-                    print(" -> can't handle this type, no known conversion")
-                    unhandled_items.append((old_key, new_key))
+        # (Committing any remaining changes to the libraries at the end, even if interrupted)
+        try:
+            concurrency = options['concurrency']
+            if options['queue']:
+                work_queue = WorkQueue(options['queue'], lease_seconds=options['lease_seconds'])
+                work_queue.add((old_key_str, new_key_str) for old_key_str, new_key_str in block_key_list)
+                if concurrency > 1:
+                    self.executor = ThreadPoolExecutor(max_workers=concurrency)
+                try:
+                    for old_key_str, new_key_str, handled in work_queue.run(self.start_push_item, window=concurrency):
+                        if not handled:
+                            unhandled_items.append((old_key_str, new_key_str))
+                        self.library_commits.commit_overdue(is_idle=self.library_is_idle)
+                finally:
+                    if self.executor:
+                        self.stop_workers(self.executor, list(self.library_tails.values()))
+            elif concurrency > 1:
+                unhandled_items = self.push_items_concurrently(block_key_list, concurrency)
             else:
-                # This is a single block. Convert and upload it:
-                result = self.convert_and_upload_olx_file(olx_dir, "definition-1.xml", old_key.block_type, new_key)
-                if not result:
-                    print(" -> can't handle this type, no known conversion")
-                    unhandled_items.append((old_key, new_key))
+                for old_key_str, new_key_str in block_key_list:
+                    if not self.push_item(old_key_str, new_key_str):
+                        unhandled_items.append((old_key_str, new_key_str))
+                    self.library_commits.commit_overdue()
+        finally:
+            if self.workers_running:
+                # Interrupted again while waiting for the workers; they may still be changing the libraries.
+                print("Not committing the libraries, since items are still being pushed")
+            else:
+                self.library_commits.flush()
+                self.push_manifest.save()
+        print("Made {} library commits".format(self.library_commits.num_commits))
+        print("Made {}".format(self.studio_client.stats()))
 
         if unhandled_items:
             print("\n\nThe following items could not be migrated:")
             for old_key, new_key in unhandled_items:
                 print("{} {}".format(old_key, new_key))
 
+    def push_items_concurrently(self, items, concurrency):
+        """
+        Push the given (old_key_str, new_key_str) items on 'concurrency'
+        threads. The items of each library are pushed one at a time, in order,
+        while different libraries are pushed in parallel.
+
+        Returns the list of items that could not be migrated, in the order given.
+        """
+        items_by_library = OrderedDict()  # Library key -> list of (position in items, old_key_str, new_key_str)
+        for position, (old_key_str, new_key_str) in enumerate(items):
+            lib_key = getattr(UsageKey.from_string(new_key_str), 'lib_key', None)
+            items_by_library.setdefault(lib_key, []).append((position, old_key_str, new_key_str))
+
+        def push_library(lib_key, library_items):
+            """ Push one library's items in order; return the ones that weren't handled """
+            unhandled = []
+            for item in library_items:
+                if self.stopping.is_set():
+                    break
+                if not self.try_push_item(item[1], item[2]):
+                    unhandled.append(item)
+            # Nothing else will change this library, so commit it now rather than at the end of the run:
+            self.library_commits.commit(lib_key)
+            return unhandled
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = [
+            executor.submit(push_library, lib_key, library_items)
+            for lib_key, library_items in items_by_library.items()
+        ]
+        try:
+            unhandled = sorted(item for future in futures for item in future.result())
+        finally:
+            self.stop_workers(executor, futures)
+        return [(old_key_str, new_key_str) for _position, old_key_str, new_key_str in unhandled]
+
+    def stop_workers(self, executor, futures):
+        """
+        Shut down a pool of worker threads once we're done with it, or have
+        been interrupted. In the latter case, the workers finish the item
+        they're pushing but don't start another one. Only returns once no
+        worker is changing any library, so that the libraries can be committed
+        from this thread.
+        """
+        if not all(future.done() for future in futures):
+            print("Stopping: waiting for the items in progress to finish...")
+            self.stopping.set()
+            for future in futures:
+                future.cancel()
+        self.workers_running = True
+        executor.shutdown(wait=True)
+        self.workers_running = False
+
+    def library_is_idle(self, lib_key):
+        """
+        Is no item of the given library being pushed (or waiting to be pushed)
+        on self.executor, so that it can be committed from the main thread?
+        """
+        tail = self.library_tails.get(lib_key)
+        return tail is None or tail.done()
+
+    def start_push_item(self, old_key_str, new_key_str):
+        """
+        Push an item claimed from a WorkQueue, when WorkQueue.run() waits for it
+        (or straight away on self.executor, if pushing concurrently).
+        """
+        if self.executor is None:
+            def wait():
+                """ Push the item; it's failed in the queue if it can't be handled """
+                handled = self.push_item(old_key_str, new_key_str)
+                return handled, None if handled else "could not be migrated automatically"
+            return wait
+
+        # Items of the same library are pushed in the order they were claimed,
+        # each one waiting for the previous one to finish:
+        lib_key = getattr(UsageKey.from_string(new_key_str), 'lib_key', None)
+        previous = self.library_tails.get(lib_key)
+
+        def push_after_previous():
+            """ Wait for the library's previous item, then push this one """
+            if previous is not None:
+                previous.exception()  # Waits for it; its outcome is reported separately
+            if self.stopping.is_set():
+                return False  # Left leased in the queue, so it's claimed again once the lease expires
+            return self.try_push_item(old_key_str, new_key_str)
+        future = self.executor.submit(push_after_previous)
+        self.library_tails[lib_key] = future
+
+        def wait_for_future():
+            """ Get the result of pushing the item """
+            handled = future.result()
+            return handled, None if handled else "could not be migrated automatically"
+        return wait_for_future
+
+    def try_push_item(self, old_key_str, new_key_str):
+        """
+        Push one item on a worker thread: like push_item(), but an error is
+        reported and counted as the item not being handled, rather than
+        stopping the other threads.
+        """
+        try:
+            return self.push_item(old_key_str, new_key_str)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception("Failed to push %s (%s)", old_key_str, new_key_str)
+            print(" -> Error pushing {}; see log".format(old_key_str))
+            return False
+
+    def push_item(self, old_key_str, new_key_str):
+        """
+        Convert and upload the OLX of one root (old_key_str) to the Blockstore
+        block new_key_str.
+
+        Returns True if the item was migrated, or False if it can't be done automatically.
+        """
+        old_key = UsageKey.from_string(old_key_str)
+        new_key = UsageKey.from_string(new_key_str)
+        print("Processing {} ({})".format(old_key, new_key))
+
+        root = root_name(old_key)
+
+        # Various cases:
+        if old_key.block_type == 'vertical':
+            # This is a vertical block. What kind of children does it have?
+            vertical_olx_str = self.read_olx(root, 'definition-1.xml')
+            olx_root = etree.fromstring(vertical_olx_str)
+            children_refs = [node.attrib["definition"] for node in olx_root.iter("xblock-include")]
+            if len(children_refs) == 1:
+                # This vertical actually contains only a single block:
+                old_block_type, old_block_id = children_refs[0].split("/")
+                result = self.convert_and_upload_olx_file(
+                    root, "definition-{}-{}.xml".format(old_block_type, old_block_id), old_block_type, new_key,
+                )
+                if not result:
+                    return False
+            elif new_key.block_type == 'unit':
+                # Upload each child OLX:
+                worked = True
+                for child_ref in children_refs:
+                    child_block_type, child_block_id = child_ref.split("/")
+                    child_new_key = LibraryUsageLocatorV2(
+                        lib_key=new_key.lib_key,
+                        block_type=child_block_type,
+                        usage_id=child_block_id,
+                    )
+                    # (A block in the push manifest was pushed and committed already, so it must exist)
+                    known = not self.verify_remote and self.push_manifest.is_pushed(child_new_key)
+                    if not known and not self.studio_client.library_has_block(child_new_key):
+                        # Before we can upload the OLX we have to create the child block:
+                        self.studio_client.add_block_to_library(
+                            child_new_key.lib_key,
+                            child_block_type,
+                            child_block_id,
+                            parent_block=new_key,
+                        )
+                        self.library_commits.changed(child_new_key.lib_key)
+                    # Now update the OLX of the child block:
+                    result = self.convert_and_upload_olx_file(
+                        root,
+                        "definition-{}-{}.xml".format(child_block_type, child_block_id),
+                        child_block_type,
+                        child_new_key,
+                    )
+                    worked = worked and result
+                if worked:
+                    self.set_block_olx(new_key, vertical_olx_str)
+                else:
+                    return False
+            else:
+                print(" -> can't handle this type, no known conversion")
+                return False
+        else:
+            # This is a single block. Convert and upload it:
+            result = self.convert_and_upload_olx_file(root, "definition-1.xml", old_key.block_type, new_key)
+            if not result:
+                print(" -> can't handle this type, no known conversion")
+                return False
+        return True
+
     def set_logging(self, verbosity):
         """
         Set the logging level depending on the desired verbosity
@@ -177,7 +406,11 @@ class Command(BaseCommand):
         new_olx can be an OLX string or an etree Element node
         """
         if not isinstance(new_olx, six.string_types):
-            new_olx = etree.tostring(new_olx, encoding="utf-8", pretty_print=True)
+            new_olx = etree.tostring(new_olx, encoding="unicode", pretty_print=True)
+        olx_hash = hash_olx(new_olx.strip().encode('utf-8'))
+        if not self.verify_remote and self.push_manifest.is_pushed(block_key, olx_hash):
+            print(" -> No change to OLX of {} since it was last pushed".format(block_key))
+            return
         try:
             existing_olx = self.studio_client.get_library_block_olx(block_key)
         except HTTPError:
@@ -186,12 +419,25 @@ class Command(BaseCommand):
             existing_olx = "unknown"
         if existing_olx.strip() != new_olx.strip():
             self.studio_client.set_library_block_olx(block_key, new_olx)
-            self.studio_client.commit_library_changes(block_key.lib_key)
             print(" -> Updated OLX of {}".format(block_key))
         else:
+            # The OLX we compared with may be an uncommitted draft (e.g. left by
+            # an interrupted run), so this still needs the library committed.
             print(" -> No change to OLX of {}".format(block_key))
+        # Recorded in the push manifest once the library is committed:
+        self.push_manifest.add_pending(block_key, olx_hash)
+        self.library_commits.changed(block_key.lib_key)
 
-    def convert_and_upload_olx_file(self, olx_dir, olx_file, old_block_type, new_key):
+    def read_olx(self, root, olx_file):
+        """
+        Read one of the exported OLX files of the given root, as a string.
+        """
+        olx_bytes = self.olx_store.read(root, olx_file)
+        if olx_bytes is None:
+            raise IOError("OLX file {} of {} not found".format(olx_file, root))
+        return six.text_type(olx_bytes, encoding="utf-8")
+
+    def convert_and_upload_olx_file(self, root, olx_file, old_block_type, new_key):
         """
         Given a single OLX file (with no children), convert it if necessary from
         old_block_type to new_key.block_type and upload it to Blockstore (as
@@ -199,9 +445,7 @@ class Command(BaseCommand):
 
         Returns True if the block can be migrated and False otherwise
         """
-
-        with open(olx_dir + '/' + olx_file, 'r') as fh:
-            olx_string = six.text_type(fh.read(), encoding="utf-8")
+        olx_string = self.read_olx(root, olx_file)
 
         if old_block_type == new_key.block_type:
             if new_key.block_type in ('html', 'video', 'drag-and-drop-v2', 'problem'):
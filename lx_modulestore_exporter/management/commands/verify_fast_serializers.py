@@ -0,0 +1,90 @@
+"""
+Check that the fast serializers produce the same OLX as the generic
+add_xml_to_node() path, for every block of the given types in a tree
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import difflib
+from argparse import ArgumentError
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from lxml import etree
+from opaque_keys import InvalidKeyError
+from opaque_keys.edx.keys import UsageKey
+
+from ... import compat
+from ...adapters import export_session
+from ...block_serializer import serialize_with_add_xml_to_node
+from ...fast_serializers import FAST_SERIALIZERS, canonical_olx, serialize_block_fast
+
+
+class Command(BaseCommand):
+    """
+    verify_fast_serializers management command.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.help = __doc__
+        self.args = {}
+
+    def add_arguments(self, parser):
+        """
+        Add named arguments.
+        """
+        self.args['block_key'] = parser.add_argument(
+            '--block-key',
+            type=str,
+            required=True,
+            nargs='+',
+            help='Usage key(s) of the root block(s) whose descendants to check, e.g. a course or a sequential'
+        )
+
+    def handle(self, *args, **options):
+        """
+        Serialize each block with a fast serializer both ways, and compare.
+        """
+        try:
+            root_keys = [UsageKey.from_string(key) for key in options['block_key']]
+        except InvalidKeyError:
+            raise ArgumentError(message='Invalid block usage key', argument=self.args['block_key'])
+
+        results = Counter()  # (block type, outcome) -> number of blocks
+        with export_session():
+            for root_key in root_keys:
+                blocks, _num_get_item_calls = compat.get_block_tree(root_key)
+                for block_key, block in blocks.items():
+                    if block_key.block_type not in FAST_SERIALIZERS:
+                        continue
+                    outcome = self.verify_block(block)
+                    results[(block_key.block_type, outcome)] += 1
+
+        for (block_type, outcome), count in sorted(results.items()):
+            print('{}: {} {}'.format(block_type, count, outcome))
+        if any(outcome == 'different' for _block_type, outcome in results):
+            raise CommandError('The fast serializers produced different OLX for some blocks (see above)')
+
+    def verify_block(self, block):
+        """
+        Compare the two ways of serializing the given block, and print the
+        differences if any. Returns 'same', 'different' or 'fell back' (if the
+        fast serializer declined this block).
+        """
+        fast_node = serialize_block_fast(block)
+        if fast_node is None:
+            return 'fell back'
+        generic_node, static_files = serialize_with_add_xml_to_node(block)
+        if canonical_olx(fast_node) == canonical_olx(generic_node) and not static_files:
+            return 'same'
+        print('Different OLX for {}:'.format(block.scope_ids.usage_id))
+        if static_files:
+            print('  generic path exported files: {}'.format(', '.join(f.name for f in static_files)))
+        diff = difflib.unified_diff(
+            etree.tostring(generic_node, encoding='unicode', pretty_print=True).splitlines(),
+            etree.tostring(fast_node, encoding='unicode', pretty_print=True).splitlines(),
+            'generic', 'fast', lineterm='',
+        )
+        for line in diff:
+            print('  ' + line)
+        return 'different'
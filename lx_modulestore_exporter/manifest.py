@@ -0,0 +1,189 @@
+"""
+Manifests of previously exported and pushed blocks, used to skip unchanged ones
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import six
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'export-manifest.json'
+
+
+def hash_olx(olx_bytes):
+    """
+    Get the hash we store for a block's emitted OLX.
+    """
+    return hashlib.sha256(olx_bytes).hexdigest()
+
+
+class ExportManifest(object):
+    """
+    Records, for each block exported to one root's output (in an OLX store;
+    see olx_storage.py), the
+    version of the block in the modulestore that was exported, the hash of
+    the OLX that was written and the static files that were uploaded for it.
+
+    On the next export, blocks whose modulestore version hasn't changed and
+    whose OLX file is still intact can be skipped entirely.
+
+    'config' describes any settings that affect the output (like where static
+    files are stored); if it differs from the config the manifest was written
+    with, the previous entries are disregarded.
+    """
+
+    def __init__(self, olx_store, root, config):
+        self.olx_store = olx_store
+        self.root = root
+        self.config = config
+        self.entries = {}  # String usage key -> dict of information about what was exported
+        self.changed = True  # Does save() need to write anything? (Only if the saved manifest is out of date)
+        manifest_bytes = olx_store.read(root, MANIFEST_FILENAME)
+        if manifest_bytes is None:
+            return  # No manifest yet
+        try:
+            data = json.loads(manifest_bytes.decode('utf-8'))
+        except ValueError:
+            return  # Not usable
+        if data.get('config') == config:
+            self.entries = data.get('blocks', {})
+            self.changed = False
+
+    def is_unchanged(self, block_key, version, olx_filename):
+        """
+        Was this version of the block already exported, with its OLX file still
+        in place and unmodified?
+        """
+        entry = self.entries.get(six.text_type(block_key))
+        if version is None or entry is None or entry['version'] != version or entry['olx_file'] != olx_filename:
+            return False
+        olx_bytes = self.olx_store.read(self.root, olx_filename)
+        return olx_bytes is not None and hash_olx(olx_bytes) == entry['olx_hash']
+
+    def record(self, block_key, version, olx_filename, olx_hash, static_files):
+        """
+        Record that the given version of a block was exported.
+
+        olx_hash is the hash_olx() of the OLX that was written, and
+        static_files is a dict of static file name -> (S3 key, size)
+        """
+        entry = {
+            'version': version,
+            'olx_file': olx_filename,
+            'olx_hash': olx_hash,
+            'static_files': static_files,
+        }
+        # (Compared as JSON, since that's how the saved entries were loaded)
+        if json.loads(json.dumps(entry)) != self.entries.get(six.text_type(block_key)):
+            self.entries[six.text_type(block_key)] = entry
+            self.changed = True
+
+    def forget(self, block_key):
+        """
+        Remove any record of the given block, so that it's exported again next time.
+        """
+        if self.entries.pop(six.text_type(block_key), None) is not None:
+            self.changed = True
+
+    def retain_only(self, block_keys):
+        """
+        Drop the entries of any blocks that are no longer part of this root.
+        """
+        keep = set(six.text_type(block_key) for block_key in block_keys)
+        if any(key not in keep for key in self.entries):
+            self.entries = {key: entry for key, entry in self.entries.items() if key in keep}
+            self.changed = True
+
+    def save(self):
+        """
+        Write the manifest out to the OLX store, unless nothing has changed
+        since it was loaded (in a pack, every write appends another copy).
+        """
+        if not self.changed:
+            return
+        data = json.dumps({'config': self.config, 'blocks': self.entries}, indent=2, sort_keys=True)
+        self.olx_store.write(self.root, MANIFEST_FILENAME, data.encode('utf-8'), atomic=True)
+        self.changed = False
+
+
+class PushManifest(object):
+    """
+    Records the hash_olx() of the OLX that push_olx last pushed (and
+    committed) for each Blockstore block key of one Studio instance, so that
+    blocks whose OLX hasn't changed since can be skipped without asking
+    Studio.
+
+    An update is only recorded once its library has been committed: until
+    then it's held as pending, via add_pending(), and confirm_library() records
+    it when the library is committed. The file can be shared by several
+    processes; save() merges in what the others have recorded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()  # String block key -> OLX hash
+        self._pending = {}  # Library key -> {string block key -> OLX hash} awaiting a commit
+        self._recorded = {}  # String block key -> OLX hash, of the entries recorded since the last save()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Read the manifest file, if there is one.
+        """
+        try:
+            with open(self.path, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def is_pushed(self, block_key, olx_hash=None):
+        """
+        Has the given block been pushed (with the given OLX, if olx_hash is specified)?
+        """
+        with self._lock:
+            pushed_hash = self.entries.get(six.text_type(block_key))
+        return pushed_hash is not None and (olx_hash is None or pushed_hash == olx_hash)
+
+    def add_pending(self, block_key, olx_hash):
+        """
+        Note that the given OLX has been pushed to a block, but not committed yet.
+        """
+        with self._lock:
+            self._pending.setdefault(block_key.lib_key, {})[six.text_type(block_key)] = olx_hash
+
+    def confirm_library(self, lib_key):
+        """
+        Record the pending updates of the given library, which has just been
+        committed, and save the manifest.
+        """
+        with self._lock:
+            committed = self._pending.pop(lib_key, {})
+            self.entries.update(committed)
+            self._recorded.update(committed)
+        self.save()
+
+    def save(self):
+        """
+        Write the manifest out to disk, merging what we've recorded into any
+        entries recorded by other processes since it was loaded.
+        """
+        with self._lock, open(self.path + '.lock', 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                entries = self._load()
+                entries.update(self._recorded)
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as fh:
+                    json.dump(entries, fh, indent=0, sort_keys=True)
+                os.rename(tmp_path, self.path)
+                self.entries = entries
+                self._recorded = {}
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
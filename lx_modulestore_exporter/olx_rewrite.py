@@ -0,0 +1,36 @@
+"""
+Code for rewriting the static file references in exported OLX
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import re
+
+STATIC_PREFIX = '/static/'
+
+# Any remaining reference to a static file, once the known ones have been rewritten:
+# (A full stop at the end is taken to end a sentence, not the file name)
+UNRESOLVED_STATIC_URL_RE = re.compile(re.escape(STATIC_PREFIX) + r'[^\s"\'<>&?#)]*[^\s"\'<>&?#).]')
+
+
+def rewrite_static_urls(olx_str, url_map):
+    """
+    Replace every '/static/<name>' reference in olx_str with url_map[name], in
+    a single pass over the text.
+
+    A name only matches if it's not immediately followed by another character
+    that would continue the file name, so e.g. 'a.png' won't match within
+    '/static/a.png.bak' (and where one name is a prefix of another, the
+    longer name wins). A full stop that isn't followed by a word character,
+    as at the end of a sentence, doesn't count.
+
+    Returns a tuple of (rewritten OLX string, sorted list of any '/static/...'
+    references that were left unresolved).
+    """
+    if url_map:
+        names = sorted(url_map, key=len, reverse=True)
+        matcher = re.compile(
+            re.escape(STATIC_PREFIX) + '(' + '|'.join(re.escape(name) for name in names) + r')(?![\w\-\+]|\.\w)'
+        )
+        olx_str = matcher.sub(lambda match: url_map[match.group(1)], olx_str)
+    unresolved = sorted(set(UNRESOLVED_STATIC_URL_RE.findall(olx_str)))
+    return olx_str, unresolved
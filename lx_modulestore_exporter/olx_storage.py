@@ -0,0 +1,239 @@
+"""
+Where exported OLX is stored: either as one file per block in a directory
+per root (the original format), or packed into a single archive file.
+
+Both kinds of store address files by root name (e.g. 'vertical-abc123', the
+name of the root's directory) and file name (e.g. 'definition-1.xml'), and
+provide the same read()/write() API, so the exporter, push_olx and the
+convert_olx command don't need to know which format they're using.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import fcntl
+import io
+import json
+import logging
+import mmap
+import os
+import threading
+import uuid
+
+log = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ('dir', 'pack')
+
+PACK_FILENAME = 'olx.pack'
+PACK_INDEX_FILENAME = 'olx.pack.index'
+
+
+def root_name(block_key):
+    """
+    Get the name under which the OLX of the given root block is stored,
+    e.g. 'vertical-abc123'
+    """
+    return block_key.block_type + '-' + block_key.block_id
+
+
+def open_olx_store(base_dir, output_format='dir'):
+    """
+    Get an OLX store of the given format ('dir' or 'pack') in base_dir.
+    """
+    if output_format == 'pack':
+        return OLXPack(base_dir)
+    return OLXDirectory(base_dir)
+
+
+class OLXDirectory(object):
+    """
+    OLX stored as one file per block, with a directory per root in base_dir.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._made_dirs = set()
+
+    def path(self, root, filename):
+        """
+        Get the path of the given file.
+        """
+        return os.path.join(self.base_dir, root, filename)
+
+    def read(self, root, filename):
+        """
+        Get the contents of the given file as bytes, or None if it doesn't exist.
+        """
+        try:
+            with open(self.path(root, filename), 'rb') as fh:
+                return fh.read()
+        except (IOError, OSError):
+            return None
+
+    def write(self, root, filename, data, atomic=False):
+        """
+        Write the given bytes to a file. If atomic is True, they're written to
+        a temporary file first so that readers never see a partial file.
+        """
+        if root not in self._made_dirs:
+            if not os.path.isdir(os.path.join(self.base_dir, root)):
+                os.mkdir(os.path.join(self.base_dir, root))
+            self._made_dirs.add(root)
+        path = self.path(root, filename)
+        log.info(" -> " + path)
+        if not atomic:
+            with open(path, 'wb') as fh:
+                fh.write(data)
+            return
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmp_path, path)
+
+    def flush(self):
+        """
+        Nothing to do; files are written straight away.
+        """
+        pass
+
+    def roots(self):
+        """
+        Get the sorted names of the roots that have any files.
+        """
+        return sorted(
+            name for name in os.listdir(self.base_dir)
+            if os.path.isdir(os.path.join(self.base_dir, name)) and self.filenames(name)
+        )
+
+    def filenames(self, root):
+        """
+        Get the sorted names of the files stored for the given root.
+        """
+        return sorted(
+            name for name in os.listdir(os.path.join(self.base_dir, root))
+            if not name.endswith('.tmp') and os.path.isfile(self.path(root, name))
+        )
+
+
+class OLXPack(object):
+    """
+    OLX stored in a single append-only pack file (olx.pack) in base_dir, plus
+    an index file (olx.pack.index) with one JSON line per file written:
+        ["<root>/<filename>", offset, length]
+    Writing a file again appends a new copy, and the last index entry wins.
+
+    Writes are buffered until flush() (which export_data() calls once per
+    root), and then appended to both files under an exclusive lock, so
+    several processes can add to the same pack at once. A process only sees
+    the files that were in the index when it opened the pack, plus the ones
+    it has written itself. Reads come from a read-only mmap of the pack.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.pack_path = os.path.join(base_dir, PACK_FILENAME)
+        self.index_path = os.path.join(base_dir, PACK_INDEX_FILENAME)
+        self.index = {}  # "<root>/<filename>" -> (offset, length)
+        self._pending = {}  # "<root>/<filename>" -> data written but not yet flushed
+        self._pending_order = []
+        self._mmap = None
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _load_index(self):
+        """
+        Read the index file, if there is one.
+        """
+        try:
+            fh = io.open(self.index_path, 'r', encoding='utf-8')
+        except (IOError, OSError):
+            return
+        with fh:
+            for line in fh:
+                try:
+                    path, offset, length = json.loads(line)
+                except ValueError:
+                    continue  # Partially written by a process that crashed
+                self.index[path] = (offset, length)
+
+    def _mapped(self, end):
+        """
+        Get an mmap of the pack that extends to at least 'end' bytes,
+        re-mapping it if the pack has grown. Must be called with the lock held.
+        """
+        if self._mmap is None or len(self._mmap) < end:
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.pack_path, 'rb') as fh:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read(self, root, filename):
+        """
+        Get the contents of the given file as bytes, or None if it doesn't exist.
+        """
+        path = root + '/' + filename
+        with self._lock:
+            if path in self._pending:
+                return self._pending[path]
+            if path not in self.index:
+                return None
+            offset, length = self.index[path]
+            if length == 0:
+                return b''
+            return self._mapped(offset + length)[offset:offset + length]
+
+    def write(self, root, filename, data, atomic=False):  # pylint: disable=unused-argument
+        """
+        Add a file to the pack, on the next flush(). (Flushes are always atomic.)
+        """
+        path = root + '/' + filename
+        with self._lock:
+            if path not in self._pending:
+                self._pending_order.append(path)
+            self._pending[path] = data
+
+    def flush(self):
+        """
+        Append all of the files written since the last flush to the pack.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            with open(self.pack_path, 'ab') as pack_fh, io.open(self.index_path, 'a', encoding='utf-8') as index_fh:
+                fcntl.flock(pack_fh, fcntl.LOCK_EX)
+                try:
+                    pack_fh.seek(0, os.SEEK_END)
+                    offset = pack_fh.tell()
+                    entries = []
+                    for path in self._pending_order:
+                        data = self._pending[path]
+                        pack_fh.write(data)
+                        entries.append((path, offset, len(data)))
+                        offset += len(data)
+                    # The data must be in place before the index points to it:
+                    pack_fh.flush()
+                    os.fsync(pack_fh.fileno())
+                    index_fh.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+                    index_fh.flush()
+                finally:
+                    fcntl.flock(pack_fh, fcntl.LOCK_UN)
+            for path, offset, length in entries:
+                self.index[path] = (offset, length)
+            self._pending = {}
+            self._pending_order = []
+
+    def roots(self):
+        """
+        Get the sorted names of the roots that have any files.
+        """
+        with self._lock:
+            paths = list(self.index) + self._pending_order
+        return sorted(set(path.split('/', 1)[0] for path in paths))
+
+    def filenames(self, root):
+        """
+        Get the sorted names of the files stored for the given root.
+        """
+        prefix = root + '/'
+        with self._lock:
+            paths = list(self.index) + self._pending_order
+        return sorted(set(path[len(prefix):] for path in paths if path.startswith(prefix)))
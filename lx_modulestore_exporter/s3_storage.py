@@ -0,0 +1,311 @@
+"""
+Helpers for storing static asset files in S3
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import compat
+
+log = logging.getLogger(__name__)
+
+# Folder (within LX_EXPORTER_STATIC_FILES_PATH) holding content-addressed assets
+CONTENT_ADDRESSED_FOLDER = 'sha256/'
+
+_s3 = {}  # Holds the boto3 Bucket from get_s3_bucket(), once created
+_s3_lock = threading.Lock()
+
+
+def get_s3_bucket():
+    """
+    Get the boto3 Bucket that static files are stored in
+    (LX_EXPORTER_STATIC_FILES_BUCKET).
+
+    boto3 is only imported, and the session only set up, the first time this
+    is called, so commands that don't use S3 don't pay for it. The Bucket is
+    then shared by all threads: they make their requests through its client,
+    whose connection pool is sized by LX_EXPORTER_S3_MAX_POOL_CONNECTIONS.
+    """
+    with _s3_lock:
+        if 'bucket' not in _s3:
+            import boto3
+            from botocore.config import Config
+
+            session = boto3.Session(
+                aws_access_key_id=settings.LX_EXPORTER_AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.LX_EXPORTER_AWS_ACCESS_KEY_SECRET,
+            )
+            config = Config(max_pool_connections=settings.LX_EXPORTER_S3_MAX_POOL_CONNECTIONS)
+            _s3['bucket'] = session.resource('s3', config=config).Bucket(settings.LX_EXPORTER_STATIC_FILES_BUCKET)
+        return _s3['bucket']
+
+
+def content_addressed_key(path_prefix, static_file):
+    """
+    Get the S3 key under which the given StaticFile is stored in
+    content-addressed mode, e.g.
+        learning-item-assets/sha256/ab/cdef0123...89.png
+
+    The file extension is kept so that the URLs remain recognizable.
+    """
+    if static_file.data is not None:
+        digest = hashlib.sha256(static_file.data).hexdigest()
+    else:
+        # Hash large files chunk by chunk, rather than loading them into memory.
+        # That uses up the stream, so get a fresh one for the upload to read:
+        sha256 = hashlib.sha256()
+        for chunk in static_file.stream.stream_data():
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+        static_file.stream = compat.reopen_asset_stream(static_file.stream)
+    extension = os.path.splitext(static_file.name)[1].lower()
+    return path_prefix + CONTENT_ADDRESSED_FOLDER + digest[:2] + '/' + digest[2:] + extension
+
+
+class ContentStreamReader(object):
+    """
+    Minimal read-only file-like object wrapping a contentstore
+    StaticContentStream, so that it can be passed to boto3's managed
+    (multipart) upload without loading the whole file into memory.
+    """
+
+    def __init__(self, content):
+        self._chunks = content.stream_data()
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        """
+        Read up to 'size' bytes (or everything that's left, if size is negative)
+        """
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if not chunk:
+                break
+            self._buffer.extend(chunk)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class S3ObjectIndex(object):
+    """
+    In-memory index of the objects in our S3 bucket, used to avoid issuing a
+    HEAD request for every static file we might need to upload.
+
+    Whole prefixes are listed once (one request per page of 1,000 keys) and
+    the resulting key -> (size, ETag) mapping is kept for the rest of the
+    run. Keys outside of any listed prefix fall back to a HEAD request, whose
+    result is cached too.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.objects = {}  # Key -> (size, ETag) of every object known to exist
+        self.missing = set()  # Keys outside of the listed prefixes known not to exist
+        self.listed_prefixes = set()
+        self.num_requests = 0
+        self._lock = threading.Lock()
+
+    def load_prefix(self, prefix):
+        """
+        List every object whose key starts with 'prefix', unless we already have.
+
+        'prefix' must be a folder, i.e. end with a '/'.
+        """
+        with self._lock:
+            if prefix in self.listed_prefixes:
+                return
+            paginator = self.bucket.meta.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket.name, Prefix=prefix):
+                self.num_requests += 1
+                for obj in page.get('Contents', []):
+                    self.objects[obj['Key']] = (obj['Size'], obj['ETag'])
+            self.listed_prefixes.add(prefix)
+
+    def _is_listed(self, key):
+        """
+        Is 'key' within one of the prefixes (folders) that we've fully listed?
+        """
+        end = key.find('/')
+        while end != -1:
+            if key[:end + 1] in self.listed_prefixes:
+                return True
+            end = key.find('/', end + 1)
+        return False
+
+    def has_object(self, key):
+        """
+        Does our S3 bucket have the specified file/object/key?
+        """
+        if key in self.objects:
+            return True
+        if self._is_listed(key) or key in self.missing:
+            return False
+        # Not covered by any listing; ask S3 directly:
+        self.num_requests += 1
+        client = self.bucket.meta.client
+        try:
+            obj = client.head_object(Bucket=self.bucket.name, Key=key)
+        except client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == "404":
+                # The object does not exist.
+                self.missing.add(key)
+                return False
+            else:
+                # Something else has gone wrong.
+                raise
+        self.add(key, obj['ContentLength'], obj['ETag'])
+        return True
+
+    def add(self, key, size, etag):
+        """
+        Record that an object has been uploaded to the bucket.
+
+        'etag' may be None if it isn't known (e.g. after a multipart upload).
+        """
+        self.objects[key] = (size, etag)
+        self.missing.discard(key)
+
+
+class AssetUploader(object):
+    """
+    Uploads static asset files to S3 on a bounded pool of worker threads, so
+    that serializing and writing OLX can continue while bytes are in flight.
+
+    Each upload is done at most once per destination key (unless it failed),
+    no matter how many blocks reference it, and any failures are reported
+    back against every block that needed the file.
+
+    To bound memory use, submit() blocks while the data of queued and
+    in-progress uploads exceeds max_inflight_bytes (a single file larger than
+    that is still allowed through on its own).
+    """
+
+    def __init__(self, bucket, index, max_workers=8, max_inflight_bytes=256 * 1024 * 1024):
+        self.bucket = bucket
+        self.index = index
+        self.max_inflight_bytes = max_inflight_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._uploads = {}  # Destination key -> Future of its upload
+        self._block_uploads = OrderedDict()  # Block key -> list of (destination key, Future)
+        self._inflight_bytes = 0
+        self._lock = threading.Lock()
+        self._upload_finished = threading.Condition(self._lock)
+
+    @staticmethod
+    def _memory_size(static_file):
+        """
+        How much memory will the given StaticFile use while it's waiting to be
+        uploaded and being uploaded?
+        """
+        if static_file.data is not None:
+            return static_file.size
+        # Streamed files only hold the parts that are being uploaded (_put()
+        # limits boto3 to buffering that many parts):
+        parts_size = settings.LX_EXPORTER_MULTIPART_CHUNK_SIZE * settings.LX_EXPORTER_MULTIPART_CONCURRENCY
+        return min(static_file.size, parts_size)
+
+    def submit(self, block_key, static_file, dest_key):
+        """
+        Queue the upload of the given StaticFile to 'dest_key', on behalf of the
+        block 'block_key', unless it's already in S3.
+        """
+        with self._lock:
+            future = self._uploads.get(dest_key)
+            if future is None or (future.done() and future.exception() is not None):
+                if self.index.has_object(dest_key):
+                    print(" -> already uploaded static asset {}".format(static_file.name))
+                    self._close(static_file)
+                    return
+                # Apply backpressure if too much data is waiting to be uploaded:
+                size = self._memory_size(static_file)
+                while self._inflight_bytes and self._inflight_bytes + size > self.max_inflight_bytes:
+                    self._upload_finished.wait()
+                self._inflight_bytes += size
+                print(" -> Uploading static asset file to S3: {} -> {}".format(static_file.name, dest_key))
+                future = self._executor.submit(self._upload, static_file, dest_key, size)
+                self._uploads[dest_key] = future
+            else:
+                self._close(static_file)
+            self._block_uploads.setdefault(block_key, []).append((dest_key, future))
+
+    def _upload(self, static_file, dest_key, size):
+        """
+        Upload a single file, then release the memory it was counted as using.
+        Runs on a worker thread.
+        """
+        try:
+            self._put(static_file, dest_key)
+        finally:
+            with self._lock:
+                self._inflight_bytes -= size
+                self._upload_finished.notify_all()
+
+    def _put(self, static_file, dest_key):
+        """
+        Upload a single file to S3.
+        """
+        client = self.bucket.meta.client
+        if static_file.data is not None:
+            response = client.put_object(Bucket=self.bucket.name, Key=dest_key, Body=static_file.data)
+            self.index.add(dest_key, static_file.size, response['ETag'])
+            return
+        from boto3.s3.transfer import TransferConfig
+
+        # Stream large files from the contentstore as a multipart upload, so
+        # that at most a few parts of it are held in memory at any time:
+        config = TransferConfig(
+            multipart_threshold=settings.LX_EXPORTER_MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=settings.LX_EXPORTER_MULTIPART_CHUNK_SIZE,
+            max_concurrency=settings.LX_EXPORTER_MULTIPART_CONCURRENCY,
+        )
+        # Our stream isn't seekable, so s3transfer reads parts into memory
+        # ahead of uploading them; by default up to 10, more than
+        # _memory_size() counts. (boto3's TransferConfig doesn't take this as
+        # an argument, but s3transfer reads it from the config.)
+        config.max_in_memory_upload_chunks = settings.LX_EXPORTER_MULTIPART_CONCURRENCY
+        try:
+            client.upload_fileobj(ContentStreamReader(static_file.stream), self.bucket.name, dest_key, Config=config)
+        finally:
+            self._close(static_file)
+        self.index.add(dest_key, static_file.size, None)
+
+    @staticmethod
+    def _close(static_file):
+        """
+        Release the contentstore stream of a StaticFile, if it has one.
+        """
+        if static_file.stream is not None:
+            static_file.stream.close()
+
+    def wait(self, block_keys):
+        """
+        Wait for all the uploads needed by the given blocks to complete.
+
+        Returns an OrderedDict of block key -> list of (destination key,
+        exception) for any uploads that failed.
+        """
+        failures = OrderedDict()
+        for block_key in block_keys:
+            with self._lock:
+                uploads = self._block_uploads.pop(block_key, [])
+            for dest_key, future in uploads:
+                exc = future.exception()
+                if exc is not None:
+                    failures.setdefault(block_key, []).append((dest_key, exc))
+        return failures
+
+    def shutdown(self):
+        """
+        Wait for any remaining uploads and stop the worker threads.
+        """
+        self._executor.shutdown(wait=True)
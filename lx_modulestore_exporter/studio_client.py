@@ -3,9 +3,14 @@ API client for connecting to Studio
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import threading
+import time
+
 import requests
 from django.conf import settings
 from oauthlib.oauth2 import BackendApplicationClient, TokenExpiredError
+from opaque_keys.edx.locator import LibraryUsageLocatorV2
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 import six
 
@@ -21,49 +26,126 @@ URL_LIB_BLOCK_OLX = URL_LIB_BLOCK + 'olx/'  # Get or set the OLX of the specifie
 URL_BLOCK_RENDER_VIEW = '/api/xblock/v2/xblocks/{block_key}/view/{view_name}/'
 URL_BLOCK_GET_HANDLER_URL = '/api/xblock/v2/xblocks/{block_key}/handler_url/{handler_name}/'
 
+# Get a new access token this many seconds before the current one expires:
+TOKEN_REFRESH_MARGIN = 60
+
+
+def _pooled(session, pool_size):
+    """
+    Make the given requests Session keep up to pool_size connections per
+    host alive for re-use, and return it.
+    """
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 class StudioClient(object):
     """
     API client for Studio
+
+    Can be used from several threads at once: pool_size should be at least
+    the number of threads, so that each can keep its own connection alive.
+    The access token is shared by all threads, and is refreshed shortly before
+    it expires (or when a request is rejected with a 401), by one thread only.
     """
 
-    def __init__(self, studio_url, config):
+    def __init__(self, studio_url, config, pool_size=10):
         self.studio_url = studio_url
         self.client_oauth_key = config['oauth_key']
         self.client_oauth_secret = config['oauth_secret']
         self.client = BackendApplicationClient(client_id=self.client_oauth_key)
-        self.session = OAuth2Session(client=self.client)
+        self.session = _pooled(OAuth2Session(client=self.client), pool_size)
+        self.token_session = _pooled(requests.Session(), 1)
         self.token_url = config['lms_oauth2_url'] + '/access_token'
+        self._token_expires_at = 0  # time.time() at which we should have a new token
+        self._token_version = 0  # Incremented each time the token is refreshed
+        self._token_lock = threading.Lock()
+        # Counters, for reporting:
+        self.num_requests = 0
+        self.request_seconds = 0.0  # Total time spent waiting for API responses
+        self.num_token_refreshes = 0
+        self._counters_lock = threading.Lock()
+        self._library_blocks = {}  # String library key -> set of the string keys of the blocks in it
+        self._library_blocks_lock = threading.Lock()
 
-    def refresh_session_token(self):
+    def refresh_session_token(self, stale_version=None):
         """
         Refreshes the authenticated session with a new token.
+
+        If stale_version is given, the token is only refreshed if it's still
+        that version, i.e. no other thread has refreshed it in the meantime.
+        """
+        with self._token_lock:
+            if stale_version is not None and stale_version != self._token_version:
+                return
+            # We cannot use lms_session.fetch_token() because it sends the client
+            # credentials using HTTP basic auth instead of as POST form data.
+            res = self.token_session.post(self.token_url, data={
+                'client_id': self.client_oauth_key,
+                'client_secret': self.client_oauth_secret,
+                'grant_type': 'client_credentials'
+            })
+            res.raise_for_status()
+            data = res.json()
+            self.session.token = {'access_token': data['access_token']}
+            # Without an expiry time, we rely on a 401 to tell us to refresh it:
+            expires_in = data.get('expires_in')
+            self._token_expires_at = time.time() + expires_in - TOKEN_REFRESH_MARGIN if expires_in else float('inf')
+            self._token_version += 1
+            self.num_token_refreshes += 1
+
+    def _current_token_version(self):
+        """
+        Get the version of the current access token, refreshing the token
+        first if it's about to expire.
         """
-        # We cannot use lms_session.fetch_token() because it sends the client
-        # credentials using HTTP basic auth instead of as POST form data.
-        res = requests.post(self.token_url, data={
-            'client_id': self.client_oauth_key,
-            'client_secret': self.client_oauth_secret,
-            'grant_type': 'client_credentials'
-        })
-        res.raise_for_status()
-        data = res.json()
-        self.session.token = {'access_token': data['access_token']}
+        version = self._token_version
+        if time.time() >= self._token_expires_at:
+            self.refresh_session_token(stale_version=version)
+            version = self._token_version
+        return version
+
+    def _request(self, method, url, **kwargs):
+        """
+        Make an HTTP request with our authenticated session, counting it.
+        """
+        start = time.time()
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            with self._counters_lock:
+                self.num_requests += 1
+                self.request_seconds += time.time() - start
 
     def api_call_raw(self, method, path, **kwargs):
         """
-        Make a Studio API call and return the HTTP response.
+        Make a Studio API call and return the HTTP response. 'path' may also
+        be a full URL, e.g. the 'next' link of a paginated response.
         """
-        url = self.studio_url + path
+        url = path if path.startswith('http') else self.studio_url + path
+        token_version = self._current_token_version()
         try:
-            response = self.session.request(method, url, **kwargs)
+            response = self._request(method, url, **kwargs)
             if response.status_code == 401:
                 raise TokenExpiredError
         except TokenExpiredError:
-            self.refresh_session_token()
-            response = self.session.request(method, url, **kwargs)
+            # (If several threads get a 401 at once, only the first refreshes the token)
+            self.refresh_session_token(stale_version=token_version)
+            response = self._request(method, url, **kwargs)
         return response
 
+    def stats(self):
+        """
+        Get a summary of the API requests made so far, for printing.
+        """
+        with self._counters_lock:
+            num_requests, request_seconds = self.num_requests, self.request_seconds
+        return "{} Studio API requests, taking {:.0f} ms on average; {} access token refreshes".format(
+            num_requests, 1000 * request_seconds / num_requests if num_requests else 0, self.num_token_refreshes,
+        )
+
     def api_call(self, method, path, **kwargs):
         """
         Make an API call from Studio. Returns the parsed JSON response.
@@ -88,11 +170,58 @@ class StudioClient(object):
         self.api_call('post', URL_LIB_COMMIT.format(lib_key=lib_key))
     
     def add_block_to_library(self, lib_key, block_type, slug, parent_block=None):
-        """ Add a new XBlock to the library """
+        """
+        Add a new XBlock to the library. If it turns out to exist already (e.g.
+        another process created it since we got the library's list of blocks),
+        that counts as success.
+        """
         block_info = {"block_type": block_type, "definition_id": slug}
         if parent_block:
             block_info["parent_block"] = six.text_type(parent_block)
-        data = self.api_call('post', URL_LIB_BLOCKS.format(lib_key=lib_key), json=block_info)
+        response = self.api_call_raw('post', URL_LIB_BLOCKS.format(lib_key=lib_key), json=block_info)
+        if response.status_code == 400:
+            # Studio's response when the block already exists; check whether that's why:
+            data = self.get_library_block(LibraryUsageLocatorV2(lib_key, block_type, slug))
+            if data is None:
+                response.raise_for_status()
+        else:
+            response.raise_for_status()
+            data = response.json()
+        with self._library_blocks_lock:
+            if six.text_type(lib_key) in self._library_blocks:
+                self._library_blocks[six.text_type(lib_key)].add(data["id"])
+        return data
+
+    def get_library_blocks(self, lib_key):
+        """
+        Get the list of all of the blocks in a library, following the pages
+        of the response if it's paginated.
+        """
+        data = self.api_call('get', URL_LIB_BLOCKS.format(lib_key=lib_key))
+        if isinstance(data, list):
+            return data
+        blocks = data["results"]
+        while data.get("next"):
+            data = self.api_call('get', data["next"])
+            blocks.extend(data["results"])
+        return blocks
+
+    def library_has_block(self, block_key):
+        """
+        Does the given block exist in its library?
+
+        The library's list of blocks is fetched the first time one of its
+        blocks is checked, and kept up to date by add_block_to_library(), so
+        later checks don't need to make any requests.
+        """
+        lib_key = six.text_type(block_key.lib_key)
+        with self._library_blocks_lock:
+            block_keys = self._library_blocks.get(lib_key)
+        if block_keys is None:
+            block_keys = set(block["id"] for block in self.get_library_blocks(block_key.lib_key))
+            with self._library_blocks_lock:
+                block_keys = self._library_blocks.setdefault(lib_key, block_keys)
+        return six.text_type(block_key) in block_keys
 
     def get_library_block(self, block_key):
         """ Get a specific block in the library """
@@ -101,3 +230,80 @@ class StudioClient(object):
             return None
         response.raise_for_status()
         return response.json()
+
+
+class BatchedLibraryCommits(object):
+    """
+    Commits the changes made to each library in batches, rather than after
+    every change: once a library has max_changes uncommitted changes, or its
+    oldest uncommitted change is more than max_seconds old (checked when it
+    next changes, or by commit_overdue() for libraries that have stopped
+    changing). flush() commits whatever is left. on_commit(lib_key), if
+    given, is called after each commit.
+
+    Changes to any one library must not be made from more than one thread at
+    a time, as a library is committed on the thread that changes it.
+    """
+
+    def __init__(self, studio_client, max_changes=100, max_seconds=300, on_commit=None):
+        self.studio_client = studio_client
+        self.on_commit = on_commit
+        self.max_changes = max_changes
+        self.max_seconds = max_seconds
+        self.num_commits = 0
+        self._pending = {}  # Library key -> (number of uncommitted changes, time of the first one)
+        self._lock = threading.Lock()
+
+    def changed(self, lib_key):
+        """
+        Record a change to the given library, committing it if it's due.
+        """
+        now = time.time()
+        with self._lock:
+            num_changes, first_change_at = self._pending.get(lib_key, (0, now))
+            num_changes += 1
+            due = num_changes >= self.max_changes or now - first_change_at >= self.max_seconds
+            self._pending[lib_key] = (num_changes, first_change_at)
+        if due:
+            self.commit(lib_key)
+
+    def commit(self, lib_key):
+        """
+        Commit the given library's changes now.
+        """
+        with self._lock:
+            num_changes, _first_change_at = self._pending.pop(lib_key, (0, None))
+        if not num_changes:
+            return
+        self.studio_client.commit_library_changes(lib_key)
+        with self._lock:
+            self.num_commits += 1
+        print(" -> Committed {} change(s) to {}".format(num_changes, lib_key))
+        if self.on_commit:
+            self.on_commit(lib_key)
+
+    def commit_overdue(self, is_idle=None):
+        """
+        Commit every library whose oldest uncommitted change is more than
+        max_seconds old. is_idle(lib_key), if given, says whether a library
+        can be committed from this thread now, i.e. no other thread is
+        changing it; any that can't are left for later.
+        """
+        now = time.time()
+        with self._lock:
+            lib_keys = [
+                lib_key for lib_key, (_num_changes, first_change_at) in self._pending.items()
+                if now - first_change_at >= self.max_seconds
+            ]
+        for lib_key in lib_keys:
+            if is_idle is None or is_idle(lib_key):
+                self.commit(lib_key)
+
+    def flush(self):
+        """
+        Commit all of the libraries that have uncommitted changes.
+        """
+        with self._lock:
+            lib_keys = list(self._pending)
+        for lib_key in lib_keys:
+            self.commit(lib_key)
@@ -0,0 +1,105 @@
+"""
+Tests for the on-disk asset cache.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mock import patch
+
+from lx_modulestore_exporter.asset_cache import RESCAN_SECONDS, DiskAssetCache
+
+
+class FakeContent(object):
+    """
+    Stands in for a contentstore StaticContentStream.
+    """
+
+    def __init__(self, name, data):
+        self.location = 'asset-v1:LabXchange+101+2019+type@asset+block@' + name
+        self.content_digest = name
+        self.data = data
+        self.length = len(data)
+
+    def stream_data(self):
+        """
+        Yield the data in one chunk.
+        """
+        yield self.data
+
+    def close(self):
+        pass
+
+
+class DiskAssetCacheTestCase(TestCase):
+    """
+    Tests for DiskAssetCache.
+    """
+
+    def setUp(self):
+        super(DiskAssetCacheTestCase, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.now = time.time()
+        patcher = patch('lx_modulestore_exporter.asset_cache.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wrap(self, cache, name, size=10):
+        """
+        Pass an asset through the cache, two minutes after the previous one.
+        """
+        self.now += 120
+        return cache.wrap(FakeContent(name, b'x' * size))
+
+    def read(self, asset):
+        return b''.join(asset.stream_data())
+
+    def test_hit_and_miss(self):
+        cache = DiskAssetCache(self.cache_dir, 100)
+        self.assertEqual(self.read(self.wrap(cache, 'a.png')), b'x' * 10)
+        self.assertEqual(self.read(self.wrap(cache, 'a.png')), b'x' * 10)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used_without_rescanning(self):
+        cache = DiskAssetCache(self.cache_dir, 25)
+        a = self.wrap(cache, 'a.png')
+        b = self.wrap(cache, 'b.png')
+        self.wrap(cache, 'a.png')  # Now b is the least recently used
+        with patch('lx_modulestore_exporter.asset_cache.os.walk') as walk:
+            c = self.wrap(cache, 'c.png')
+        walk.assert_not_called()
+        self.assertTrue(os.path.exists(a.path))
+        self.assertFalse(os.path.exists(b.path))
+        self.assertTrue(os.path.exists(c.path))
+
+    def test_does_not_evict_files_just_used(self):
+        cache = DiskAssetCache(self.cache_dir, 15)
+        a = self.wrap(cache, 'a.png')
+        self.now -= 110  # So a was used 10 seconds before b is added
+        b = self.wrap(cache, 'b.png')
+        self.assertTrue(os.path.exists(a.path))
+        self.assertTrue(os.path.exists(b.path))
+
+    def test_index_is_loaded_from_disk(self):
+        cache = DiskAssetCache(self.cache_dir, 25)
+        a = self.wrap(cache, 'a.png')
+        self.wrap(cache, 'b.png')
+        # Another process, or the next run, sees the files already there:
+        cache = DiskAssetCache(self.cache_dir, 25)
+        self.wrap(cache, 'c.png')
+        self.assertFalse(os.path.exists(a.path))
+        self.assertEqual(cache.misses, 1)
+
+    def test_rescans_occasionally(self):
+        cache = DiskAssetCache(self.cache_dir, 25)
+        other_process = DiskAssetCache(self.cache_dir, 25)
+        a = self.wrap(other_process, 'a.png')
+        self.wrap(other_process, 'b.png')
+        self.now += RESCAN_SECONDS
+        self.wrap(cache, 'c.png')  # Finds a and b, so the cache is over its limit
+        self.assertFalse(os.path.exists(a.path))
@@ -0,0 +1,107 @@
+"""
+Tests that the fast serializers produce the same OLX as the generic
+add_xml_to_node() path.
+
+Meant to be run in Studio's virtualenv; see the Makefile's 'test' target.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from xmodule.modulestore.django import modulestore
+from xmodule.modulestore.tests.django_utils import ModuleStoreTestCase
+from xmodule.modulestore.tests.factories import CourseFactory, ItemFactory
+
+from lx_modulestore_exporter.adapters import export_session
+from lx_modulestore_exporter.block_serializer import serialize_with_add_xml_to_node
+from lx_modulestore_exporter.fast_serializers import canonical_olx, serialize_block_fast
+
+PROBLEM_DATA = """
+<problem>
+  <multiplechoiceresponse>
+    <p>Which of these is a prime number?</p>
+    <choicegroup type="MultipleChoice">
+      <choice correct="false">4</choice>
+      <choice correct="true">7</choice>
+    </choicegroup>
+  </multiplechoiceresponse>
+</problem>
+"""
+
+
+class FastSerializerTestCase(ModuleStoreTestCase):
+    """
+    Build blocks of each type that has a fast serializer, and compare both ways of serializing them.
+    """
+
+    def setUp(self):
+        super(FastSerializerTestCase, self).setUp()
+        self.course = CourseFactory.create()
+        self.sequential = ItemFactory.create(parent=self.course, category='sequential')
+        self.vertical = ItemFactory.create(parent=self.sequential, category='vertical', display_name='Unit 1')
+
+    def assert_same_olx(self, block):
+        """
+        Check that the fast serializer handles the given block, and produces
+        the same OLX (and no static files) as the generic path.
+        """
+        block = modulestore().get_item(block.location)
+        with export_session():
+            fast_node = serialize_block_fast(block)
+            generic_node, static_files = serialize_with_add_xml_to_node(block)
+        self.assertIsNotNone(fast_node)
+        self.assertEqual(static_files, [])
+        self.assertEqual(canonical_olx(fast_node), canonical_olx(generic_node))
+
+    def test_problem(self):
+        problem = ItemFactory.create(
+            parent=self.vertical,
+            category='problem',
+            display_name='Primes',
+            data=PROBLEM_DATA,
+            metadata={'max_attempts': 3, 'weight': 2.0, 'showanswer': 'finished'},
+        )
+        self.assert_same_olx(problem)
+
+    def test_vertical(self):
+        ItemFactory.create(parent=self.vertical, category='html', data='<p>Hello</p>')
+        self.assert_same_olx(self.vertical)
+
+    def test_video(self):
+        video = ItemFactory.create(
+            parent=self.vertical,
+            category='video',
+            display_name='A video',
+            metadata={
+                'youtube_id_1_0': 'p2Q6BrNhdh8',
+                'html5_sources': ['https://example.com/video.mp4'],
+                'start_time': '00:00:10',
+                'download_video': True,
+                'track': 'https://example.com/track.srt',
+                'transcripts': {'de': 'german.srt', 'en': 'english.srt'},
+            },
+        )
+        self.assert_same_olx(video)
+
+    def test_video_with_edx_video_id_falls_back(self):
+        video = ItemFactory.create(parent=self.vertical, category='video', metadata={'edx_video_id': 'abc-123'})
+        block = modulestore().get_item(video.location)
+        with export_session():
+            self.assertIsNone(serialize_block_fast(block))
+
+    def test_drag_and_drop_v2(self):
+        drag_and_drop = ItemFactory.create(
+            parent=self.vertical,
+            category='drag-and-drop-v2',
+            display_name='Sort the planets',
+            question_text='Drag each planet to its zone',
+            max_attempts=2,
+            show_title=False,
+        )
+        self.assert_same_olx(drag_and_drop)
+
+    def test_generic_path_leaves_children_alone(self):
+        html = ItemFactory.create(parent=self.vertical, category='html', data='<p>Hello</p>')
+        block = modulestore().get_item(self.vertical.location)
+        with export_session():
+            olx_node, _static_files = serialize_with_add_xml_to_node(block)
+        self.assertEqual(len(olx_node), 0)  # No child elements
+        self.assertEqual(block.children, [html.location])
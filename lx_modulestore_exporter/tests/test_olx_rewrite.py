@@ -0,0 +1,53 @@
+"""
+Tests for rewriting static file references in OLX.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from unittest import TestCase
+
+from lx_modulestore_exporter.olx_rewrite import rewrite_static_urls
+
+S3 = 'https://bucket.s3.amazonaws.com/assets/'
+
+
+class RewriteStaticUrlsTestCase(TestCase):
+    """
+    Tests for rewrite_static_urls().
+    """
+
+    def test_rewrite(self):
+        olx, unresolved = rewrite_static_urls(
+            '<img src="/static/a.png"/><a href="/static/a.png">A</a>', {'a.png': S3 + 'a.png'},
+        )
+        self.assertEqual(olx, '<img src="{0}a.png"/><a href="{0}a.png">A</a>'.format(S3))
+        self.assertEqual(unresolved, [])
+
+    def test_name_that_is_a_prefix_of_another(self):
+        url_map = {'a.png': S3 + 'short', 'a.png.bak': S3 + 'long'}
+        olx, unresolved = rewrite_static_urls('"/static/a.png.bak" "/static/a.png" (/static/a.png)', url_map)
+        self.assertEqual(olx, '"{0}long" "{0}short" ({0}short)'.format(S3))
+        self.assertEqual(unresolved, [])
+
+    def test_prefix_name_alone_does_not_match_longer_reference(self):
+        olx, unresolved = rewrite_static_urls('"/static/a.png2" "/static/a.png"', {'a.png': S3 + 'a.png'})
+        self.assertEqual(olx, '"/static/a.png2" "{}a.png"'.format(S3))
+        self.assertEqual(unresolved, ['/static/a.png2'])
+
+    def test_full_stop_after_reference(self):
+        olx, unresolved = rewrite_static_urls(
+            '<p>See /static/a.png. Or /static/a.png.bak.</p>', {'a.png': S3 + 'a.png'},
+        )
+        self.assertEqual(olx, '<p>See {}a.png. Or /static/a.png.bak.</p>'.format(S3))
+        self.assertEqual(unresolved, ['/static/a.png.bak'])
+
+    def test_query_string_is_kept(self):
+        olx, unresolved = rewrite_static_urls('<a href="/static/doc.pdf?raw">Doc</a>', {'doc.pdf': S3 + 'doc.pdf'})
+        self.assertEqual(olx, '<a href="{}doc.pdf?raw">Doc</a>'.format(S3))
+        self.assertEqual(unresolved, [])
+
+    def test_unresolved_references(self):
+        olx, unresolved = rewrite_static_urls(
+            '<img src="/static/missing.png?raw"/> "/static/b.png" "/static/missing.png"', {},
+        )
+        self.assertEqual(olx, '<img src="/static/missing.png?raw"/> "/static/b.png" "/static/missing.png"')
+        self.assertEqual(unresolved, ['/static/b.png', '/static/missing.png'])
@@ -0,0 +1,78 @@
+"""
+Tests for the OLX stores.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lx_modulestore_exporter.olx_storage import OLXDirectory, OLXPack, open_olx_store
+
+
+class OLXStoreTestCase(TestCase):
+    """
+    Tests for both kinds of OLX store.
+    """
+
+    def setUp(self):
+        super(OLXStoreTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_open_olx_store(self):
+        self.assertIsInstance(open_olx_store(self.tmp_dir), OLXDirectory)
+        self.assertIsInstance(open_olx_store(self.tmp_dir, 'pack'), OLXPack)
+
+    def test_directory_round_trip(self):
+        store = OLXDirectory(self.tmp_dir)
+        store.write('vertical-a', 'definition-1.xml', b'<vertical/>')
+        store.write('vertical-a', 'export-manifest.json', b'{}', atomic=True)
+        store = OLXDirectory(self.tmp_dir)
+        self.assertEqual(store.read('vertical-a', 'definition-1.xml'), b'<vertical/>')
+        self.assertIsNone(store.read('vertical-a', 'missing.xml'))
+        self.assertEqual(store.roots(), ['vertical-a'])
+        self.assertEqual(store.filenames('vertical-a'), ['definition-1.xml', 'export-manifest.json'])
+
+    def test_pack_round_trip(self):
+        pack = OLXPack(self.tmp_dir)
+        pack.write('vertical-a', 'definition-1.xml', b'first')
+        pack.write('vertical-b', 'definition-1.xml', b'')
+        # Written but not flushed yet:
+        self.assertEqual(pack.read('vertical-a', 'definition-1.xml'), b'first')
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'olx.pack')))
+        pack.flush()
+        pack.write('vertical-a', 'definition-1.xml', b'second')
+        pack.write('vertical-a', 'definition-2.xml', b'other')
+        pack.flush()
+
+        reopened = OLXPack(self.tmp_dir)
+        self.assertEqual(reopened.read('vertical-a', 'definition-1.xml'), b'second')  # The last write wins
+        self.assertEqual(reopened.read('vertical-a', 'definition-2.xml'), b'other')
+        self.assertEqual(reopened.read('vertical-b', 'definition-1.xml'), b'')
+        self.assertIsNone(reopened.read('vertical-c', 'definition-1.xml'))
+        self.assertEqual(reopened.roots(), ['vertical-a', 'vertical-b'])
+        self.assertEqual(reopened.filenames('vertical-a'), ['definition-1.xml', 'definition-2.xml'])
+
+    def test_pack_ignores_partial_index_line(self):
+        pack = OLXPack(self.tmp_dir)
+        pack.write('vertical-a', 'definition-1.xml', b'data')
+        pack.flush()
+        # As if another process crashed while appending to the index:
+        with open(os.path.join(self.tmp_dir, 'olx.pack.index'), 'a') as index_fh:
+            index_fh.write('["vertical-b/definition-1.xml", 4')
+        reopened = OLXPack(self.tmp_dir)
+        self.assertEqual(reopened.read('vertical-a', 'definition-1.xml'), b'data')
+        self.assertEqual(reopened.roots(), ['vertical-a'])
+
+    def test_two_packs_appending(self):
+        first = OLXPack(self.tmp_dir)
+        second = OLXPack(self.tmp_dir)
+        first.write('vertical-a', 'definition-1.xml', b'from first')
+        second.write('vertical-b', 'definition-1.xml', b'from second')
+        first.flush()
+        second.flush()
+        reopened = OLXPack(self.tmp_dir)
+        self.assertEqual(reopened.read('vertical-a', 'definition-1.xml'), b'from first')
+        self.assertEqual(reopened.read('vertical-b', 'definition-1.xml'), b'from second')
@@ -0,0 +1,91 @@
+"""
+Tests for uploading static asset files to S3.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import boto3
+from botocore.stub import Stubber
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from lx_modulestore_exporter.block_serializer import StaticFile
+from lx_modulestore_exporter.s3_storage import AssetUploader, S3ObjectIndex
+
+MB = 1024 * 1024
+
+
+class FakeStream(object):
+    """
+    Stands in for a contentstore StaticContentStream.
+    """
+
+    def __init__(self, data, chunk_size=MB):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def stream_data(self):
+        """
+        Yield the data in chunks.
+        """
+        for start in range(0, len(self.data), self.chunk_size):
+            yield self.data[start:start + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBucket(object):
+    """
+    Stands in for a boto3 Bucket, using the given client.
+    """
+
+    def __init__(self, client):
+        self.name = 'test-bucket'
+        self.meta = type(str('Meta'), (object,), {'client': client})
+
+
+@override_settings(LX_EXPORTER_MULTIPART_CHUNK_SIZE=5 * MB, LX_EXPORTER_MULTIPART_CONCURRENCY=2)
+class StreamedUploadTestCase(SimpleTestCase):
+    """
+    Tests for the multipart upload of files too large to hold in memory.
+    """
+
+    def setUp(self):
+        super(StreamedUploadTestCase, self).setUp()
+        self.client = boto3.client(
+            's3', region_name='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret',
+        )
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        self.bucket = FakeBucket(self.client)
+        self.index = S3ObjectIndex(self.bucket)
+
+    def test_streamed_upload(self):
+        key = 'assets/big.mp4'
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+        # (Parameters aren't checked, since which ones are sent varies between boto3 versions)
+        self.stubber.add_response('create_multipart_upload', {'UploadId': 'upload-1'})
+        for _part in range(3):  # 11 MB in 5 MB parts
+            self.stubber.add_response('upload_part', {'ETag': '"part"'})
+        self.stubber.add_response('complete_multipart_upload', {})
+        stream = FakeStream(b'x' * (11 * MB))
+        static_file = StaticFile(name='big.mp4', size=len(stream.data), stream=stream)
+
+        uploader = AssetUploader(self.bucket, self.index, max_workers=1)
+        with patch.object(self.client, 'upload_fileobj', wraps=self.client.upload_fileobj) as upload_fileobj:
+            uploader.submit('block-key', static_file, key)
+            failures = uploader.wait(['block-key'])
+            uploader.shutdown()
+
+        self.assertEqual(failures, {})
+        self.stubber.assert_no_pending_responses()
+        self.assertTrue(stream.closed)
+        self.assertTrue(self.index.has_object(key))
+        config = upload_fileobj.call_args[1]['Config']
+        self.assertEqual(config.multipart_chunksize, 5 * MB)
+        self.assertEqual(config.max_concurrency, 2)
+        # So that boto3 holds no more parts in memory than AssetUploader counts:
+        self.assertEqual(config.max_in_memory_upload_chunks, 2)
@@ -0,0 +1,134 @@
+"""
+Tests for the Studio API client.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+from unittest import TestCase
+
+import six
+from mock import patch
+from opaque_keys.edx.locator import LibraryLocatorV2, LibraryUsageLocatorV2
+from requests import Response
+from requests.exceptions import HTTPError
+
+from lx_modulestore_exporter.studio_client import BatchedLibraryCommits, StudioClient
+
+LIB_KEY = LibraryLocatorV2.from_string('lib:LabXchange:test')
+BLOCK_KEY = LibraryUsageLocatorV2(LIB_KEY, 'problem', 'p1')
+
+
+def make_response(status_code, data=None):
+    """
+    Make a requests Response with the given status and JSON data.
+    """
+    response = Response()
+    response.status_code = status_code
+    response._content = json.dumps(data).encode('utf-8')  # pylint: disable=protected-access
+    return response
+
+
+def make_client():
+    """
+    Make a StudioClient that doesn't connect anywhere until asked to.
+    """
+    return StudioClient('https://studio.example.com', {
+        'oauth_key': 'key',
+        'oauth_secret': 'secret',
+        'lms_oauth2_url': 'https://lms.example.com/oauth2',
+    })
+
+
+class AddBlockToLibraryTestCase(TestCase):
+    """
+    Tests for StudioClient.add_block_to_library().
+    """
+
+    def setUp(self):
+        super(AddBlockToLibraryTestCase, self).setUp()
+        self.client = make_client()
+        # The library's list of blocks was fetched before the block was created:
+        self.client._library_blocks[six.text_type(LIB_KEY)] = set()  # pylint: disable=protected-access
+
+    def test_add_block(self):
+        created = make_response(200, {'id': six.text_type(BLOCK_KEY)})
+        with patch.object(self.client, 'api_call_raw', return_value=created):
+            data = self.client.add_block_to_library(LIB_KEY, 'problem', 'p1')
+        self.assertEqual(data['id'], six.text_type(BLOCK_KEY))
+        self.assertTrue(self.client.library_has_block(BLOCK_KEY))
+
+    def test_block_already_exists(self):
+        # e.g. another process created it since the list of blocks was fetched:
+        exists = make_response(400, {'detail': "An XBlock with ID 'p1' already exists"})
+        found = make_response(200, {'id': six.text_type(BLOCK_KEY)})
+        with patch.object(self.client, 'api_call_raw', side_effect=[exists, found]):
+            data = self.client.add_block_to_library(LIB_KEY, 'problem', 'p1')
+        self.assertEqual(data['id'], six.text_type(BLOCK_KEY))
+        self.assertTrue(self.client.library_has_block(BLOCK_KEY))
+
+    def test_other_error(self):
+        invalid = make_response(400, {'detail': 'Invalid block type'})
+        with patch.object(self.client, 'api_call_raw', side_effect=[invalid, make_response(404)]):
+            with self.assertRaises(HTTPError):
+                self.client.add_block_to_library(LIB_KEY, 'problem', 'p1')
+        self.assertFalse(self.client.library_has_block(BLOCK_KEY))
+
+
+class FakeStudioClient(object):
+    """
+    Records the libraries that get committed.
+    """
+
+    def __init__(self):
+        self.committed = []
+
+    def commit_library_changes(self, lib_key):
+        self.committed.append(lib_key)
+
+
+class BatchedLibraryCommitsTestCase(TestCase):
+    """
+    Tests for BatchedLibraryCommits.
+    """
+
+    def setUp(self):
+        super(BatchedLibraryCommitsTestCase, self).setUp()
+        self.now = 1000.0
+        patcher = patch('lx_modulestore_exporter.studio_client.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.studio_client = FakeStudioClient()
+        self.on_commit = []
+        self.commits = BatchedLibraryCommits(
+            self.studio_client, max_changes=3, max_seconds=60, on_commit=self.on_commit.append,
+        )
+
+    def test_commit_after_max_changes(self):
+        for _change in range(3):
+            self.commits.changed('lib-a')
+        self.assertEqual(self.studio_client.committed, ['lib-a'])
+        self.assertEqual(self.on_commit, ['lib-a'])
+
+    def test_commit_overdue(self):
+        self.commits.changed('lib-a')
+        self.now += 30
+        self.commits.changed('lib-b')
+        self.commits.commit_overdue()
+        self.assertEqual(self.studio_client.committed, [])
+        # lib-a stops changing, but is committed once its first change is max_seconds old:
+        self.now += 30
+        self.commits.commit_overdue()
+        self.assertEqual(self.studio_client.committed, ['lib-a'])
+        self.now += 30
+        self.commits.commit_overdue()
+        self.assertEqual(self.studio_client.committed, ['lib-a', 'lib-b'])
+        self.assertEqual(self.commits.num_commits, 2)
+
+    def test_commit_overdue_skips_busy_libraries(self):
+        self.commits.changed('lib-a')
+        self.commits.changed('lib-b')
+        self.now += 60
+        self.commits.commit_overdue(is_idle=lambda lib_key: lib_key != 'lib-a')
+        self.assertEqual(self.studio_client.committed, ['lib-b'])
+        self.commits.flush()
+        self.assertEqual(self.studio_client.committed, ['lib-b', 'lib-a'])
@@ -0,0 +1,100 @@
+"""
+Tests for splitting work between processes with shards and a WorkQueue.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lx_modulestore_exporter.work_queue import DONE, FAILED, LEASED, PENDING, WorkQueue, in_shard, shard_spec
+
+
+class ShardTestCase(TestCase):
+    """
+    Tests for shard_spec() and in_shard().
+    """
+
+    def test_shard_spec(self):
+        self.assertEqual(shard_spec('0/4'), (0, 4))
+        self.assertEqual(shard_spec('3/4'), (3, 4))
+        for bad_spec in ('4/4', '-1/4', '1', 'a/b', '1/0'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                shard_spec(bad_spec)
+
+    def test_every_key_in_exactly_one_shard(self):
+        keys = ['block-v1:LabXchange+101+2019+type@vertical+block@{}'.format(i) for i in range(1000)]
+        shards = [[key for key in keys if in_shard(key, (index, 4))] for index in range(4)]
+        self.assertEqual(sorted(key for shard in shards for key in shard), sorted(keys))
+        for shard in shards:
+            # Roughly even, since the split is by hash:
+            self.assertGreater(len(shard), 150)
+
+    def test_no_shard(self):
+        self.assertTrue(in_shard('anything', None))
+
+
+class WorkQueueTestCase(TestCase):
+    """
+    Tests for WorkQueue.
+    """
+
+    def setUp(self):
+        super(WorkQueueTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'queue.sqlite')
+
+    def make_queue(self, owner, lease_seconds=3600):
+        """
+        Open the queue as a process called 'owner' would.
+        """
+        queue = WorkQueue(self.path, lease_seconds=lease_seconds)
+        queue.owner = owner
+        return queue
+
+    def test_claim_in_order_once(self):
+        queue = self.make_queue('a')
+        queue.add([('k1', 'd1'), ('k2', 'd2')])
+        queue.add([('k1', 'ignored'), ('k3', None)])
+        other = self.make_queue('b')
+        self.assertEqual(queue.claim(), ('k1', 'd1'))
+        self.assertEqual(other.claim(), ('k2', 'd2'))
+        self.assertEqual(queue.claim(), ('k3', None))
+        self.assertIsNone(other.claim())
+        self.assertEqual(queue.counts(), {LEASED: 3})
+
+    def test_expired_lease_is_claimed_again(self):
+        crashed = self.make_queue('crashed', lease_seconds=-1)  # Its leases have always expired
+        crashed.add([('k1', None)])
+        self.assertEqual(crashed.claim(), ('k1', None))
+        other = self.make_queue('other')
+        self.assertEqual(other.claim(), ('k1', None))
+        self.assertIsNone(other.claim())  # Leased to 'other' now, and not expired
+
+    def test_finish_ignores_stale_owner(self):
+        slow = self.make_queue('slow', lease_seconds=-1)
+        slow.add([('k1', None), ('k2', None)])
+        slow.claim()
+        other = self.make_queue('other')
+        other.claim()
+        # 'slow' finishes after its lease expired and 'other' took the item over:
+        slow.fail('k1', 'too late')
+        self.assertEqual(other.counts(), {LEASED: 1, PENDING: 1})
+        other.complete('k1')
+        self.assertEqual(other.counts(), {DONE: 1, PENDING: 1})
+
+    def test_run(self):
+        queue = self.make_queue('a')
+        queue.add([('k1', 'd1'), ('k2', 'd2'), ('k3', 'd3')])
+
+        def start(key, data):
+            """ Items succeed, except k2 """
+            return lambda: (data.upper(), 'failed' if key == 'k2' else None)
+
+        results = list(queue.run(start, window=2))
+        self.assertEqual(results, [('k1', 'd1', 'D1'), ('k2', 'd2', 'D2'), ('k3', 'd3', 'D3')])
+        self.assertEqual(queue.counts(), {DONE: 2, FAILED: 1})
+        self.assertIsNone(queue.claim())  # Failed items aren't claimed again
@@ -0,0 +1,173 @@
+"""
+Splitting a list of roots between several processes or hosts: either
+statically (--shard i/N) or dynamically via a shared SQLite work queue.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import hashlib
+import os
+import socket
+import sqlite3
+import time
+from collections import deque
+
+# States of an item in the WorkQueue
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def shard_spec(string):
+    """
+    Parse a '--shard i/N' argument into a tuple of (i, N), where 0 <= i < N.
+    """
+    try:
+        index, count = (int(part) for part in string.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not of the form i/N'.format(string))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('Shard index must be from 0 to N-1, got {}'.format(string))
+    return index, count
+
+
+def in_shard(key_str, shard):
+    """
+    Is the root with the given key part of the given (i, N) shard? Based on a
+    hash of the key, so every host agrees no matter the order of its ID list.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return int(hashlib.sha1(key_str.encode('utf-8')).hexdigest(), 16) % count == index
+
+
+class WorkQueue(object):
+    """
+    A queue of items (roots to export or push) in a SQLite database, which
+    any number of processes - on one host, or on several hosts sharing a
+    volume that supports file locking - can claim items from.
+
+    Each item has a key and optional data (e.g. the Blockstore key to push a
+    root to). Claiming an item leases it to the claiming process for
+    lease_seconds; it's then marked done or failed. If the process dies
+    first, the lease expires and the item can be claimed again. Items are
+    claimed in the order they were first added.
+    """
+
+    def __init__(self, path, lease_seconds=3600):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        # Autocommit mode; transactions are begun explicitly where needed:
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            ' key TEXT PRIMARY KEY, data TEXT, position INTEGER NOT NULL, state TEXT NOT NULL,'
+            ' owner TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS items_by_state ON items (state, position)')
+
+    def add(self, items):
+        """
+        Add the given (key, data) items to the queue, ignoring any that are already in it.
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            position = self._db.execute('SELECT COALESCE(MAX(position), 0) FROM items').fetchone()[0]
+            for key, data in items:
+                position += 1
+                self._db.execute(
+                    'INSERT OR IGNORE INTO items (key, data, position, state) VALUES (?, ?, ?, ?)',
+                    (key, data, position, PENDING),
+                )
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def claim(self):
+        """
+        Lease the next pending item (or one whose lease has expired) to this
+        process. Returns its (key, data), or None if there's nothing left to claim.
+        """
+        now = time.time()
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._db.execute(
+                'SELECT key, data FROM items WHERE state = ? OR (state = ? AND lease_expires < ?)'
+                ' ORDER BY position LIMIT 1',
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    'UPDATE items SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE key = ?',
+                    (LEASED, self.owner, now + self.lease_seconds, row[0]),
+                )
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+        return tuple(row) if row is not None else None
+
+    def _finish(self, key, state, error=None):
+        """
+        Mark an item that this process leased as done or failed. (If the lease
+        expired and someone else has claimed it since, their claim stands.)
+        """
+        self._db.execute(
+            'UPDATE items SET state = ?, error = ?, lease_expires = NULL WHERE key = ? AND owner = ? AND state = ?',
+            (state, error, key, self.owner, LEASED),
+        )
+
+    def complete(self, key):
+        """
+        Mark an item as done.
+        """
+        self._finish(key, DONE)
+
+    def fail(self, key, error):
+        """
+        Mark an item as failed, with the given error message. It won't be
+        claimed again.
+        """
+        self._finish(key, FAILED, error)
+
+    def counts(self):
+        """
+        Get a dict of state -> number of items in that state.
+        """
+        return dict(self._db.execute('SELECT state, COUNT(*) FROM items GROUP BY state').fetchall())
+
+    def run(self, start, window=1):
+        """
+        Claim items and process them until there are none left, keeping up to
+        'window' of them claimed at once.
+
+        start(key, data) must begin processing an item and return a function
+        that waits for it to finish and returns a tuple of (result, error
+        message or None). Yields (key, data, result) in the order the items
+        were claimed, after marking each one as done or failed.
+        """
+        in_progress = deque()  # (key, data, function to wait for the result)
+        while True:
+            while len(in_progress) < window:
+                item = self.claim()
+                if item is None:
+                    break
+                key, data = item
+                in_progress.append((key, data, start(key, data)))
+            if not in_progress:
+                return
+            key, data, wait = in_progress.popleft()
+            try:
+                result, error = wait()
+            except Exception as exc:
+                self.fail(key, '{}: {}'.format(type(exc).__name__, exc))
+                raise
+            if error:
+                self.fail(key, error)
+            else:
+                self.complete(key)
+            yield key, data, result